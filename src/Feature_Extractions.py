@@ -1,171 +1,981 @@
 import numpy as np
 from PIL import Image
-from scipy.fftpack import dct
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from collections import deque, namedtuple
+from fnmatch import fnmatch
+from functools import lru_cache, partial
+from itertools import chain, islice
+import copy
+import heapq
+import io
+import math
+import os
+import shutil
+import struct
 import sys
 import time
+import zipfile
 project_root = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(project_root))# ! streamlit nested files error
 
-from src.utils import UnionFind, similarity_score, hamming_distance, LSH
+from src.hash_cache import HashCache, file_digest
+from src.profiling import StageTimer, latency_summary
+from src.sharding import run_shards
+from src.utils import (UnionFind, hamming_distance, distance_to_similarity, pack_bits, LSH, HASH_BITS, WORD_BITS,
+                       iter_bruteforce_pairs, threshold_to_max_distance, MultiIndexHash, _empty_edges,
+                       connected_components, component_groups, estimate_lsh, tune_lsh, hash_bits_of, unpack_bits)
 
-def perceptual_hash(image_path, hash_size=32):
+_DCT_BASES = {}
+
+# fast decode keeps at least this many times the hash size before the final resize
+FAST_DECODE_OVERSAMPLE = 8
+
+# hashes sampled to estimate (and auto-tune) the LSH layout on the actual data
+LSH_TUNING_SAMPLE = 2000
+
+# with prefetching, file contents sent to hashing workers but not hashed yet stay under this many bytes
+PREFETCH_MAX_BYTES = 256 << 20
+
+
+def dct_basis(size, coeffs=8):
+    """
+    Precomputed 2-D DCT-II basis for the low-frequency coeffs×coeffs block.
+    Matches scipy.fftpack.dct(dct(x.T).T)[:coeffs, :coeffs] (type II, unnormalised)
+    as a single (coeffs², size²) matrix acting on flattened size×size images.
+    """
+    key = (size, coeffs)
+    if key not in _DCT_BASES:
+        n = np.arange(size)
+        k = np.arange(coeffs)[:, None]
+        basis_1d = 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+        _DCT_BASES[key] = np.kron(basis_1d, basis_1d)
+    return _DCT_BASES[key]
+
+
+@lru_cache(maxsize=None)
+def dct_layout(hash_bits=HASH_BITS):
+    """
+    Low-frequency DCT coefficients behind a hash_bits-bit hash.
+    They come from the smallest square block holding hash_bits coefficients, lowest
+    frequencies (u + v) first, kept in row-major order; 64 bits is the whole 8x8 block.
+    Returns: (block size, flat indices of the kept coefficients, kept positions the median is taken over)
+    """
+    if hash_bits < WORD_BITS or hash_bits % WORD_BITS:
+        raise ValueError(f"Hash size must be a positive multiple of {WORD_BITS} bits, got {hash_bits}")
+    coeffs = math.isqrt(hash_bits - 1) + 1
+    u, v = np.divmod(np.arange(coeffs * coeffs), coeffs)
+    kept = np.sort(np.argsort(u + v, kind='stable')[:hash_bits])
+    # the first row (u = 0) stays out of the median, as in the 64-bit hash
+    return coeffs, kept, np.flatnonzero(u[kept] > 0)
+
+
+def perceptual_hash_batch(pixels, hash_bits=HASH_BITS):
+    """
+    Hash a stack of downscaled grayscale images at once.
+    All low-frequency DCT blocks come from one matrix product with the
+    precomputed basis; medians and thresholds are vectorized.
+    
+    Args:
+        pixels: (N, hash_size, hash_size) array of grayscale pixels
+        hash_bits: Hash size, a multiple of 64 (see dct_layout)
+    Returns:
+        (N,) uint64 array of packed hashes, (N, hash_bits // 64) for wider hashes
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    n, size = pixels.shape[0], pixels.shape[-1]
+    coeffs, kept, median_idx = dct_layout(hash_bits)
+    if coeffs > size:
+        raise ValueError(f"{hash_bits}-bit hashes need images of at least {coeffs}x{coeffs} pixels, got {size}")
+    dct_low = pixels.reshape(n, size * size) @ dct_basis(size, coeffs)[kept].T
+    median = np.median(dct_low[:, median_idx], axis=1)
+    return pack_bits(dct_low > median[:, None])
+
+
+def _load_pixels(image_path, hash_size=32, fast_decode=False):
+    """
+    Decode an image and downscale it to a hash_size × hash_size grayscale array.
+    image_path may be a path, an open PIL image, a binary file-like object, or a
+    zero-argument callable returning one (opened here and closed after decoding).
+    fast_decode lets the JPEG decoder scale down in the DCT domain (draft mode)
+    and box-reduces to a few times the target size before the final LANCZOS
+    resize, instead of decoding every pixel at native resolution.
+    """
+    if isinstance(image_path, Image.Image):
+        img = image_path
+    elif callable(image_path):
+        with image_path() as stream:
+            return _load_pixels(stream, hash_size, fast_decode)
+    else:
+        with Image.open(image_path) as img:
+            return _load_pixels(img, hash_size, fast_decode)
+    
+    if fast_decode:
+        oversample = hash_size * FAST_DECODE_OVERSAMPLE
+        img.draft('L', (oversample, oversample))  # no-op for non-JPEG images
+        img = img.convert('L')
+        factor = min(img.size) // oversample
+        if factor > 1:
+            img = img.reduce(factor)
+    
+    img = img.convert('L')
+    img = img.resize((hash_size, hash_size), Image.LANCZOS)
+    return np.array(img, dtype=np.float32)
+
+
+def perceptual_hash(image_path, hash_size=32, fast_decode=False, hash_bits=HASH_BITS):
     """
     Generate perceptual hash for an image using DCT.
-    Returns: Binary hash string 64 bits
+    Returns: Packed 64-bit hash (np.uint64), or an array of 64-bit words for wider hashes
     """
     try:
-        if isinstance(image_path, str):
-            img = Image.open(image_path)
-        else:
-            img = image_path
-        
-        img = img.convert('L')
-        img = img.resize((hash_size, hash_size), Image.LANCZOS)
-        pixels = np.array(img, dtype=np.float32)
-        dct_coeffs = dct(dct(pixels.T).T)
-        dct_low = dct_coeffs[:8, :8]
-        median = np.median(dct_low[1:])
-        hash_bits = ''.join('1' if dct_low[i, j] > median else '0' for i in range(8) for j in range(8))
-        return hash_bits
+        return perceptual_hash_batch(_load_pixels(image_path, hash_size, fast_decode)[None], hash_bits)[0]
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
         return None
 
 
-def find_duplicates(folder_path, algorithm, threshold, sim_method='Bruteforce', num_bands=8, rows_per_band=8):
+# algorithm -> (per-file decode step, batched hash over the decoded stack and the hash size)
+HASH_FUNCTIONS = {
+    'phash': (_load_pixels, perceptual_hash_batch),
+}
+
+
+def _open_stream(source):
     """
-    Find duplicate images  """
+    Binary stream for a path, a zero-argument opener, file contents already read
+    (bytes), or an already open file-like object. An exception (a failed read, see
+    _read_file) is raised here so it is reported for its file like any other error.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    if isinstance(source, bytes):
+        return io.BytesIO(source)
+    if isinstance(source, Exception):
+        raise source
+    if callable(source):
+        return source()
+    return nullcontext(source)
+
+
+def _hash_chunk(algorithm, paths, timer=None, **hash_params):
+    """
+    Hash a chunk of files inside a worker, collecting errors instead of raising.
+    Files are decoded one by one, then hashed together as one batch.
+    Items may also be (name, source) pairs, see iter_hash_sources; errors then carry the name.
+    hash_params go to the decode step, except hash_bits which sizes the hash.
+    timer: StageTimer to run the decode and hash steps as stages of, when hashing in-process
+    Returns: (hashes, errors, metrics) with per-file decode seconds, bytes read and batch hash seconds
+    """
+    load, hash_batch = HASH_FUNCTIONS[algorithm]
+    hash_bits = hash_params.pop('hash_bits', HASH_BITS)
+    stage = timer.stage if timer is not None else (lambda name: nullcontext())
+    decoded, ok, errors = [], [], []
+    decode_seconds = np.zeros(len(paths), dtype=np.float32)
+    bytes_read = 0
+    with stage('decode'):
+        for idx, item in enumerate(paths):
+            name, source = item if isinstance(item, tuple) else (item, item)
+            start = time.perf_counter()
+            try:
+                with _open_stream(source) as stream:
+                    offset = stream.tell()
+                    decoded.append(load(stream, **hash_params))
+                    bytes_read += stream.tell() - offset
+                ok.append(idx)
+            except Exception as e:
+                errors.append((name, str(e)))
+            decode_seconds[idx] = time.perf_counter() - start
     
-    hash_functions = {
-        'phash': perceptual_hash,
+    start = time.perf_counter()
+    hashes = [None] * len(paths)
+    if decoded:
+        with stage('hash'):
+            for idx, image_hash in zip(ok, hash_batch(np.stack(decoded), hash_bits)):
+                hashes[idx] = image_hash
+    metrics = {
+        'decode_seconds': decode_seconds,
+        'bytes_read': bytes_read,
+        'hash_seconds': time.perf_counter() - start,
     }
+    return hashes, errors, metrics
+
+
+def _chunked(items, chunk_size):
+    iterator = iter(items)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def iter_hash_images(paths, algorithm='phash', workers=None, chunk_size=64, io_threads=None,
+                     max_buffered_bytes=PREFETCH_MAX_BYTES, **hash_params):
+    """
+    Hash image files in parallel with a process pool, streaming results.
+    paths may be any iterable (e.g. a discovery generator): it is consumed lazily,
+    files are submitted in chunks of chunk_size with a bounded number of chunks
+    in flight, and results come back in input order.
     
-    hash_func = hash_functions[algorithm]
+    With io_threads, reading is split from decoding for high-latency storage (network
+    mounts): that many threads read files ahead (see _prefetch_files) and the workers
+    decode from the buffers, so reads overlap with hashing. Backpressure keeps the
+    buffered contents under max_buffered_bytes plus the read-ahead window.
     
-    image_extensions = {'.jpg', '.jpeg', '.png'}
+    Yields:
+        (chunk_hashes, chunk_errors, chunk_metrics) per chunk, see hash_images and _hash_chunk
+    """
+    hash_chunk = partial(_hash_chunk, algorithm, **hash_params)
+    paths = (str(path) for path in paths)
+    if not io_threads:
+        yield from _map_chunks(ProcessPoolExecutor, hash_chunk, _chunked(paths, chunk_size), workers)
+        return
     
-    folder = Path(folder_path)
-    if not folder.exists():
-        raise FileNotFoundError(f"Folder not found: {folder_path}")
+    chunks = _chunked(_prefetch_files(paths, io_threads, read_ahead=2 * chunk_size), chunk_size)
+    yield from _map_chunks(ProcessPoolExecutor, hash_chunk, chunks, workers, max_bytes=max_buffered_bytes)
+
+
+def _read_file(path):
+    """Contents of a file, or the OSError raised reading it."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        return e
+
+
+def _prefetch_files(paths, io_threads=8, read_ahead=128):
+    """
+    Read files ahead in a thread pool, yielding (path, contents) pairs in input order.
+    Up to io_threads reads run at once, and at most read_ahead files are read (or being
+    read) before the consumer takes them, so reading pauses when hashing falls behind.
+    A failed read yields its exception as the contents.
+    """
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(_read_file, path)))
+            if len(pending) >= read_ahead:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def _payload_bytes(chunk):
+    """Bytes of file contents carried by a chunk of (name, contents) items."""
+    return sum(len(item[1]) for item in chunk if isinstance(item, tuple) and isinstance(item[1], bytes))
+
+
+def iter_hash_sources(sources, algorithm='phash', workers=None, chunk_size=16, **hash_params):
+    """
+    Hash in-memory image sources in parallel with a thread pool, streaming results.
+    sources is an iterable of (name, source) pairs, where source is a binary
+    file-like object or a zero-argument callable opening one (e.g. ZIP members,
+    see zip_sources). Nothing is written to disk; threads are used because open
+    streams cannot be sent to worker processes, and PIL releases the GIL while decoding.
     
-    image_files = [f for f in folder.iterdir() if f.is_file() and f.suffix.lower() in image_extensions]
+    Yields:
+        (chunk_hashes, chunk_errors, chunk_metrics) per chunk, with errors as (name, error message) pairs
+    """
+    hash_chunk = partial(_hash_chunk, algorithm, **hash_params)
+    chunks = _chunked(((name, source) for name, source in sources), chunk_size)
+    yield from _map_chunks(ThreadPoolExecutor, hash_chunk, chunks, workers)
+
+
+def _map_chunks(executor_cls, func, chunks, workers=None, max_bytes=None):
+    """
+    Apply func to every chunk in an executor, keeping at most 2 * workers chunks
+    in flight, and yield the results in input order.
+    max_bytes also caps the file contents carried by the chunks in flight (see
+    _payload_bytes): the next chunk waits for older results once it would go over.
+    """
+    workers = workers or os.cpu_count() or 1
     
-    if not image_files:
-        print(f"No images found in {folder_path}")
-        return [], 0, {}
+    # a single chunk is not worth starting a pool for
+    first = next(chunks, None)
+    second = next(chunks, None) if workers > 1 else None
+    if second is None:
+        for chunk in chain([first] if first else [], chunks):
+            yield func(chunk)
+        return
     
+    with executor_cls(max_workers=workers) as executor:
+        in_flight = deque()
+        in_flight_bytes = 0
+        for chunk in chain([first, second], chunks):
+            chunk_bytes = _payload_bytes(chunk) if max_bytes is not None else 0
+            while in_flight and (len(in_flight) >= 2 * workers or
+                                 (max_bytes is not None and in_flight_bytes + chunk_bytes > max_bytes)):
+                future, done_bytes = in_flight.popleft()
+                in_flight_bytes -= done_bytes
+                yield future.result()
+            in_flight.append((executor.submit(func, chunk), chunk_bytes))
+            in_flight_bytes += chunk_bytes
+        while in_flight:
+            yield in_flight.popleft()[0].result()
+
+
+def hash_images(paths, algorithm='phash', workers=None, chunk_size=64, io_threads=None, **hash_params):
+    """
+    Hash image files in parallel with a process pool.
+    Files are submitted in chunks of chunk_size and results come back in input order.
     
+    Args:
+        paths: Image file paths
+        workers: Number of worker processes (None = all cores, 1 = hash in-process)
+        io_threads: Read files ahead with this many threads (see iter_hash_images)
+        hash_params: Extra keyword arguments for the decode step
+    Returns:
+        (hashes, errors): list of packed hashes aligned with paths (None where
+        hashing failed) and list of (path, error message) pairs
+    """
+    hashes, errors = [], []
+    for chunk_hashes, chunk_errors, _ in iter_hash_images(paths, algorithm, workers, chunk_size, io_threads,
+                                                          **hash_params):
+        hashes.extend(chunk_hashes)
+        errors.extend(chunk_errors)
+    return hashes, errors
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# one discovered image: name is its path relative to the scanned root (POSIX separators)
+ImageFile = namedtuple('ImageFile', ['name', 'path', 'size', 'mtime_ns'])
+
+
+def iter_image_files(root, extensions=IMAGE_EXTENSIONS, include=None, exclude=None, recursive=True, onerror=None):
+    """
+    Walk a folder with os.scandir and yield image files as they are found.
+    Sizes and mtimes come from the DirEntry stat results, so no extra stat per file.
     
-    hashes = {}
-    for img_path in image_files:
-        img_hash = hash_func(str(img_path))
-        if img_hash is not None:
-            hashes[img_path.name] = img_hash
+    Args:
+        extensions: Lower-case suffixes to keep
+        include: fnmatch patterns on the relative path; if given, files must match one
+        exclude: fnmatch patterns on the relative path; matching files and folders are skipped
+        recursive: Descend into sub-folders
+        onerror: Called with the OSError of a folder that cannot be listed or a file that cannot
+            be stat'ed (e.g. deleted during the scan), as for os.walk; that folder or file is skipped
+    Yields:
+        ImageFile records, folder by folder in sorted name order
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+    stack = [(str(root), '')]
+    while stack:
+        folder, prefix = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as error:
+            if onerror is not None:
+                onerror(error)
+            continue
+        sub_folders = []
+        for entry in entries:
+            rel_path = prefix + entry.name
+            if any(fnmatch(rel_path, pattern) for pattern in exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        sub_folders.append((entry.path, rel_path + '/'))
+                    continue
+                if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in extensions:
+                    continue
+                if include and not any(fnmatch(rel_path, pattern) for pattern in include):
+                    continue
+                stat = entry.stat()
+            except OSError as error:
+                if onerror is not None:
+                    onerror(error)
+                continue
+            yield ImageFile(rel_path, entry.path, stat.st_size, stat.st_mtime_ns)
+        stack.extend(reversed(sub_folders))
+
+
+def zip_sources(zip_file, extensions=IMAGE_EXTENSIONS):
+    """
+    (name, opener) pairs for the image members of an open zipfile.ZipFile,
+    in archive order, for hashing straight from the archive (see iter_hash_sources).
+    """
+    for info in zip_file.infolist():
+        if info.is_dir() or os.path.splitext(info.filename)[1].lower() not in extensions:
+            continue
+        yield info.filename, partial(zip_file.open, info)
+
+
+# zipfile internals the raw member copy relies on (present in CPython 3.8 to 3.13)
+_ZIP_RAW_COPY = all(hasattr(zipfile, attr) for attr in
+                    ('_FH_SIGNATURE', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH', '_strip_extra'))
+
+
+def copy_zip_members(source_zip, names, out_file, chunk_size=1 << 20):
+    """
+    Write the named members of an open zipfile.ZipFile into a new archive on out_file,
+    copying their compressed bytes as-is instead of decompressing and recompressing.
+    Local headers are rewritten from the central directory entries, so sizes and CRC
+    are stored up front and no data descriptor (flag bit 3) is needed.
+    This goes through zipfile internals; where they are missing, members are streamed
+    through zipfile instead (decompressed and recompressed, same result).
+    out_file must be a seekable binary file (e.g. a tempfile.TemporaryFile).
+    See src/testing/check_zip_copy.py for a round-trip check.
+    """
+    with zipfile.ZipFile(out_file, 'w') as out_zip:
+        raw_copy = _ZIP_RAW_COPY and all(hasattr(out_zip, attr) for attr in ('NameToInfo', 'start_dir', '_didModify'))
+        for name in names:
+            info = source_zip.getinfo(name)
+            if not raw_copy:
+                out_info = copy.copy(info)
+                out_info.flag_bits &= ~0x08
+                with source_zip.open(info) as src, out_zip.open(out_info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, chunk_size)
+                continue
+            source_zip.fp.seek(info.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, source_zip.fp.read(zipfile.sizeFileHeader))
+            if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile(f"Bad local file header for {name}")
+            data_offset = (info.header_offset + zipfile.sizeFileHeader +
+                           header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+            
+            raw_info = copy.copy(info)
+            raw_info.flag_bits &= ~0x08
+            raw_info.extra = zipfile._strip_extra(info.extra, (1,))  # zip64 fields are re-added as needed
+            raw_info.header_offset = out_zip.fp.tell()
+            out_zip.fp.write(raw_info.FileHeader())
+            
+            source_zip.fp.seek(data_offset)
+            remaining = info.compress_size
+            while remaining:
+                chunk = source_zip.fp.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Truncated data for {name}")
+                out_zip.fp.write(chunk)
+                remaining -= len(chunk)
+            
+            out_zip.filelist.append(raw_info)
+            out_zip.NameToInfo[raw_info.filename] = raw_info
+            out_zip.start_dir = out_zip.fp.tell()
+            out_zip._didModify = True
+    return out_file
+
+
+def find_duplicates(folder_path, algorithm, threshold, sim_method='Bruteforce', num_bands=8, rows_per_band=8,
+                    workers=None, cache=None, fast_decode=False, multiprobe=False,
+                    recursive=True, include=None, exclude=None, extensions=IMAGE_EXTENSIONS, target_recall=0.95,
+                    skip_identical=False, hooks=None, hash_bits=HASH_BITS, io_threads=None, shards=None):
+    """
+    Find duplicate images
+    Image names in the result are paths relative to folder_path.
+    folder_path may also be an iterable of (name, source) pairs hashed straight from
+    memory (see iter_hash_sources and zip_sources); cache and discovery options then do not apply.
+    multiprobe: with sim_method='lsh', also probe LSH buckets one bit away
+    num_bands='auto': pick the LSH layout from the threshold and a sample of the hashes so that
+        the expected recall reaches target_recall (see tune_lsh); multiprobe then allows probing
+    recursive, include, exclude, extensions: file discovery options, see iter_image_files
+    workers: number of hashing processes (None = all cores)
+    io_threads: read files ahead with this many threads while the workers decode (for
+        network-mounted or other high-latency storage, see iter_hash_images); folder scans only
+    shards: with sim_method 'lsh' or 'exact', split candidate generation into this many
+        bucket shards run by `workers` processes, each holding only its own buckets (see src.sharding)
+    fast_decode: decode JPEGs directly near the target size (see _load_pixels)
+    cache: HashCache (or path to its SQLite file) used to skip unchanged files
+    skip_identical: hash only one file per set of byte-identical files (same size, then same
+        content digest) and add the copies back into the groups; folder scans only
+    hooks: objects notified around every pipeline stage, e.g. to export metrics or attach
+        cProfile / tracemalloc (see src.profiling); stats['stage_times'] has the totals.
+        The decode and hash stages run inside the hashing workers: hooks only see them with
+        workers=1, otherwise their times are summed from the workers' metrics
+    hash_bits: hash size, a multiple of 64; wider hashes separate near-identical scenes better.
+        With sim_method='lsh', num_bands * rows_per_band must equal it unless num_bands='auto'
+    Returns: (group_scores, number of groups, stats); see iter_duplicates for a streaming version  """
     
-    image_names = list(hashes.keys())
-    unionf = UnionFind(image_names)
+    for event in iter_duplicates(folder_path, algorithm, threshold, sim_method=sim_method, num_bands=num_bands,
+                                 rows_per_band=rows_per_band, workers=workers, cache=cache,
+                                 fast_decode=fast_decode, multiprobe=multiprobe, recursive=recursive,
+                                 include=include, exclude=exclude, extensions=extensions,
+                                 target_recall=target_recall, skip_identical=skip_identical, hooks=hooks,
+                                 hash_bits=hash_bits, io_threads=io_threads, shards=shards):
+        if event['event'] == 'done':
+            return event['groups'], len(event['groups']), event['stats']
+
+
+def iter_duplicates(folder_path, algorithm, threshold, sim_method='Bruteforce', num_bands=8, rows_per_band=8,
+                    workers=None, cache=None, fast_decode=False, multiprobe=False,
+                    recursive=True, include=None, exclude=None, extensions=IMAGE_EXTENSIONS, target_recall=0.95,
+                    skip_identical=False, hooks=None, hash_bits=HASH_BITS, io_threads=None, shards=None):
+    """
+    Streaming version of find_duplicates (same arguments).
+    Discovery runs lazily alongside hashing, so hashes start before the scan ends.
+    Yields progress events as dicts with an 'event' key:
+        discovered: {'files'}                       image files found so far
+        hashed:     {'done', 'total'}               after each hashed chunk (total = files found so far)
+        lsh_layout: {'band_widths', 'multiprobe',   the LSH layout with its expected recall and
+                     'expected_recall',             candidate count, before candidates are generated
+                     'expected_candidates'}
+        candidates: {'pairs'}                       candidate pairs to verify (lsh / exact)
+        compared:   {'done', 'total'}               pairs compared so far
+        group:      {'group', 'avg_similarity'}     a duplicate group, as soon as it is final
+        done:       {'groups', 'stats', 'edges',    the full result, last event; edges are the
+                     'names', 'hashes', 'copies'}   (i, j, distance) arrays of above-threshold pairs
+                                                    between the hashed images; names, hashes and
+                                                    copies can be handed to iter_groups to regroup
+    Stage times cover discovery, prefilter, cache, decode, hash, tuning, index, candidates,
+    compare, grouping and scoring; decode and hash run in the workers and are summed over them.
+    """
     
-    comparison_count = 0
-    similarity_matrix = {}
+    if algorithm not in HASH_FUNCTIONS:
+        raise ValueError(f"Unknown algorithm: {algorithm}")
+    if sim_method not in ('Bruteforce', 'lsh', 'exact'):
+        raise ValueError(f"Invalid sim_method: {sim_method}. Use 'Bruteforce', 'lsh' or 'exact'")
+    if shards and sim_method == 'Bruteforce':
+        raise ValueError("Sharding needs sim_method 'lsh' or 'exact'")
+    dct_layout(hash_bits)
+    if sim_method == 'lsh' and num_bands != 'auto':
+        LSH(num_bands, rows_per_band, hash_bits=hash_bits)  # fail on a bad layout before hashing
     
-    comparison_time_brute = 0
-    comparison_time_lsh = 0
+    sources = None
+    if isinstance(folder_path, (str, os.PathLike)):
+        folder = Path(folder_path)
+        if not folder.exists():
+            raise FileNotFoundError(f"Folder not found: {folder_path}")
+    else:
+        sources, cache = folder_path, None
     
-    if sim_method == 'Bruteforce':
-        
-        start_time_brute = time.time()
-        
-        for i, img1 in enumerate(image_names):
+    hash_params = {'hash_size': 32}
+    if fast_decode:
+        hash_params['fast_decode'] = True
+    if hash_bits != HASH_BITS:
+        hash_params['hash_bits'] = hash_bits
+    owns_cache = isinstance(cache, (str, Path))
+    if owns_cache:
+        cache = HashCache(cache)
+    # a cache instance may be reused across runs: report this run's counters only
+    cache_start = cache.stats() if cache is not None else None
+    timer = StageTimer(hooks)
+    
+    # discovery feeds hashing lazily: files found so far, with their hash once known
+    image_files = []
+    file_hashes = []
+    to_hash = deque()
+    events = []
+    # folders and files the scan could not read, as (path, error) pairs
+    scan_errors = []
+    
+    def scan_error(error):
+        scan_errors.append((os.path.relpath(error.filename, folder), error.strerror or str(error)))
+    
+    # byte-identical prefilter: copy idx -> original idx, the first file seen per size and the
+    # originals per (size, digest); digests (None where unreadable) are read only for sizes seen twice
+    copy_of = {}
+    first_of_size = {}
+    originals = {}
+    digests = {}
+    
+    def digest_original(idx):
+        """Digest file idx and return the original it copies, or idx if it is the first with its bytes."""
+        try:
+            digests[idx] = file_digest(image_files[idx].path)
+        except OSError:
+            digests[idx] = None  # unreadable: let hashing report it
+            return idx
+        return originals.setdefault((image_files[idx].size, digests[idx]), idx)
+    
+    def find_original(idx):
+        """Index of an earlier file with the same bytes as file idx, or None if it is the first."""
+        first = first_of_size.setdefault(image_files[idx].size, idx)
+        if first == idx:
+            return None
+        if first not in digests:
+            # a second file of this size: only now is the first one read
+            digest_original(first)
+        original = digest_original(idx)
+        return None if original == idx else original
+    
+    def discover():
+        """Yield paths that still need hashing, looking each discovered batch up in the cache."""
+        if sources is not None:
+            files = (ImageFile(name, source, None, None) for name, source in sources)
+        else:
+            files = iter_image_files(folder, extensions=extensions, include=include, exclude=exclude,
+                                     recursive=recursive, onerror=scan_error)
+        for batch in timer.timed(_chunked(files, 256), 'discovery'):
+            offset = len(image_files)
+            image_files.extend(batch)
+            file_hashes.extend([None] * len(batch))
+            fresh = list(range(offset, len(image_files)))
+            if skip_identical and sources is None:
+                with timer.stage('prefilter'):
+                    fresh = []
+                    for idx in range(offset, len(image_files)):
+                        original = find_original(idx)
+                        if original is None:
+                            fresh.append(idx)
+                        else:
+                            copy_of[idx] = original
             
-            for img2 in image_names[i+1:]:
-                comparison_count += 1
-                distance = hamming_distance(hashes[img1], hashes[img2])
-                similarity = similarity_score(hashes[img1], hashes[img2])
-                
-                similarity_matrix[(img1, img2)] = {
-                    'hamming': distance,
-                    'similarity': similarity
-                }
-                
-                if similarity >= threshold:
-                    unionf.union(img1, img2)
-        comparison_time_brute = time.time() - start_time_brute
-    
-    elif sim_method == 'lsh':
-        start_time_lsh = time.time()
-        
-        lsh = LSH(num_bands=num_bands, rows_per_band=rows_per_band)
+            if cache is not None:
+                with timer.stage('cache'):
+                    cached = cache.lookup([image_files[idx].path for idx in fresh], algorithm, hash_params,
+                                          stats=[(image_files[idx].size, image_files[idx].mtime_ns) for idx in fresh])
+            else:
+                cached = [None] * len(fresh)
+            events.append({'event': 'discovered', 'files': len(image_files)})
+            for idx, img_hash in zip(fresh, cached):
+                file_hashes[idx] = img_hash
+                if img_hash is None:
+                    to_hash.append(idx)
+                    img_file = image_files[idx]
+                    yield img_file.path if sources is None else (img_file.name, img_file.path)
+    
+    if sources is None:
+        hash_stream = partial(iter_hash_images, io_threads=io_threads)
+    else:
+        hash_stream = iter_hash_sources
+    # with one worker, hashing runs in-process: hooks see its decode and hash stages directly
+    hash_timer = timer if workers == 1 else None
+    start_time_hash = time.time()
+    try:
+        hash_errors = []
+        hashed_files = []
+        decode_seconds = []
+        bytes_read = 0
+        reported = 0
+        for chunk_hashes, chunk_errors, chunk_metrics in hash_stream(discover(), algorithm, workers=workers,
+                                                                     timer=hash_timer, **hash_params):
+            yield from events
+            events.clear()
+            hash_errors.extend(chunk_errors)
+            decode_seconds.append(chunk_metrics['decode_seconds'])
+            bytes_read += chunk_metrics['bytes_read']
+            if hash_timer is None:
+                timer.add('decode', float(chunk_metrics['decode_seconds'].sum()))
+                timer.add('hash', chunk_metrics['hash_seconds'])
+            for img_hash in chunk_hashes:
+                idx = to_hash.popleft()
+                file_hashes[idx] = img_hash
+                hashed_files.append(idx)
+            reported = len(image_files) - len(to_hash)
+            yield {'event': 'hashed', 'done': reported, 'total': len(image_files)}
+        yield from events
+        if reported < len(image_files):
+            # the tail of the scan was all cache hits
+            yield {'event': 'hashed', 'done': len(image_files), 'total': len(image_files)}
         
-        for img_name, img_hash in hashes.items():
-            lsh.index(img_name, img_hash)
+        if cache is not None:
+            with timer.stage('cache'):
+                cache.store([image_files[idx].path for idx in hashed_files],
+                            [file_hashes[idx] for idx in hashed_files], algorithm, hash_params)
+            cache_stats = cache.stats(since=cache_start)
+        else:
+            cache_stats = {}
+    finally:
+        if owns_cache:
+            cache.close()
+    hashing_time = time.time() - start_time_hash
+    
+    if not image_files:
+        print(f"No images found in {folder_path if sources is None else 'the given sources'}")
+        yield {'event': 'done', 'groups': [], 'stats': {}}
+        return
+    
+    image_names = []
+    packed_hashes = []
+    positions = {}
+    for idx, (img_file, img_hash) in enumerate(zip(image_files, file_hashes)):
+        if img_hash is not None and idx not in copy_of:
+            positions[idx] = len(image_names)
+            image_names.append(img_file.name)
+            packed_hashes.append(img_hash)
+    
+    # byte-identical copies ride along with their original: names per hashed image, and multiplicities
+    copies = {}
+    for idx, original in copy_of.items():
+        if original in positions:
+            copies.setdefault(positions[original], []).append(image_files[idx].name)
+        else:
+            hash_errors.append((image_files[idx].path,
+                                f"identical to {image_files[original].name}, which could not be hashed"))
+    
+    # shaped from hash_bits, not the data: no file may have hashed at all
+    hashes = np.array(packed_hashes, dtype=np.uint64).reshape(
+        (-1,) if hash_bits == WORD_BITS else (-1, hash_bits // WORD_BITS))
+    for event in iter_groups(image_names, hashes, threshold, sim_method=sim_method, num_bands=num_bands,
+                             rows_per_band=rows_per_band, multiprobe=multiprobe, target_recall=target_recall,
+                             hash_bits=hash_bits,
+                             copies=copies, timer=timer, shards=shards, workers=workers):
+        if event['event'] != 'done':
+            yield event
+            continue
         
-        compared_pairs = set()
+        path_to_name = {img_file.path: img_file.name for img_file in image_files} if sources is None else {}
+        stats = {
+            'method': sim_method,
+            'hashing_time': round(hashing_time, 4),
+            'errors': ([{'file': name, 'error': error} for name, error in scan_errors] +
+                       [{'file': path_to_name.get(path, path), 'error': error} for path, error in hash_errors]),
+            **event['stats'],
+            **cache_stats
+        }
+        if skip_identical:
+            stats['decodes_avoided'] = len(copy_of)
+            stats['files_digested'] = sum(digest is not None for digest in digests.values())
+        stats['stage_times'] = {stage: round(seconds, 4) for stage, seconds in timer.times.items()}
+        stats['decode_latency'] = latency_summary(np.concatenate(decode_seconds) if decode_seconds else [])
+        stats['bytes_read'] = bytes_read
+        timer.report(stats)
         
-        for i, img1 in enumerate(image_names):
-            candidates = lsh.get_candidates(img1, hashes[img1])
-            
-            for img2 in candidates:
-                pair = tuple(sorted([img1, img2]))
-                if pair in compared_pairs:
-                    continue
-                compared_pairs.add(pair)
-                
-                comparison_count += 1
-                distance = hamming_distance(hashes[img1], hashes[img2])
-                similarity = similarity_score(hashes[img1], hashes[img2])
-                
-                similarity_matrix[(img1, img2)] = {
-                    'hamming': distance,
-                    'similarity': similarity
-                }
-                
-                if similarity >= threshold:
-                    unionf.union(img1, img2)
-        comparison_time_lsh = time.time() - start_time_lsh
+        yield {**event, 'stats': stats, 'copies': copies}
 
+
+def plan_lsh(hashes, max_distance, num_bands=8, rows_per_band=8, multiprobe=False, target_recall=0.95,
+             hash_bits=None):
+    """
+    LSH layout iter_groups uses for these hashes: tuned on a fixed sample of them when
+    num_bands='auto' (see tune_lsh), else the given band count with its estimated recall.
+    Returns:
+        dict with band_widths, multiprobe, expected_recall and expected_candidates
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    hash_bits = hash_bits or hash_bits_of(hashes)
+    n_images = len(hashes)
+    sample = hashes[np.random.default_rng(0).choice(n_images, min(n_images, LSH_TUNING_SAMPLE), replace=False)]
+    if num_bands == 'auto':
+        return tune_lsh(max_distance, target_recall, n=n_images, sample=sample, multiprobe=multiprobe,
+                        hash_bits=hash_bits)
+    lsh = LSH(num_bands=num_bands, rows_per_band=rows_per_band, multiprobe=multiprobe, hash_bits=hash_bits)
+    expected_recall, expected_candidates = estimate_lsh(lsh.band_widths, max_distance, multiprobe, n=n_images,
+                                                        sample=sample, hash_bits=hash_bits)
+    return {
+        'band_widths': lsh.band_widths,
+        'multiprobe': multiprobe,
+        'expected_recall': round(expected_recall, 4),
+        'expected_candidates': int(round(expected_candidates)),
+    }
+
+
+def iter_groups(names, hashes, threshold, sim_method='Bruteforce', num_bands=8, rows_per_band=8, multiprobe=False,
+                target_recall=0.95, copies=None, edges=None, hooks=None, timer=None, shards=None, workers=None,
+                hash_bits=None):
+    """
+    Compare, group and score already hashed images; the second half of iter_duplicates.
+    Lets callers that keep hashes around regroup at another threshold or with another
+    method without decoding anything again.
     
-    else:
-        raise ValueError(f"Invalid sim_method: {sim_method}. Use 'Bruteforce' or 'lsh'")
-    
+    Args:
+        names: Image name per hash
+        hashes: (N,) uint64 array of packed hashes, or (N, W) for hashes wider than 64 bits
+        copies: Optional {hash position: [names of byte-identical copies]} added to the groups
+        edges: Optional (i, j, distance) arrays from an earlier run at the same or a looser threshold
+            (e.g. the 'edges' of a 'done' event). They are filtered to the threshold and grouped
+            directly, skipping comparisons; with lsh they must come from the same layout
+        hooks / timer: see iter_duplicates; pass timer to record into an existing StageTimer
+        shards / workers: see iter_duplicates
+        hash_bits: Hash size; taken from the shape of hashes if not given (an empty (N,) array reads as 64 bits)
+    Yields:
+        The lsh_layout, candidates, compared, group and done events of iter_duplicates; the done
+        event also carries the names and hashes that were grouped
+    """
+    owns_timer = timer is None
+    if owns_timer:
+        timer = StageTimer(hooks)
+    copies = copies or {}
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n_images = len(names)
+    multiplicity = np.ones(n_images, dtype=np.int64)
+    for pos, copy_names in copies.items():
+        multiplicity[pos] += len(copy_names)
+    if hash_bits is None:
+        hash_bits = hash_bits_of(hashes)
+    elif hash_bits != hash_bits_of(hashes):
+        raise ValueError(f"Hashes are {hash_bits_of(hashes)} bits wide, expected {hash_bits}")
+    max_distance = threshold_to_max_distance(threshold, hash_bits)
+    sharded = bool(shards) and edges is None and sim_method != 'Bruteforce'
+    unionf = UnionFind(n_images)
     
+    comparison_count = 0
+    max_possible_comparisons = n_images * (n_images - 1) // 2
+    # above-threshold edges only, as (i, j, distance) array chunks
+    edge_chunks = []
+    # edge-based scoring: per-component sum and count of edge similarities, filled once all edges are known
+    edge_sums = edge_counts = None
     
-    duplicate_groups = unionf.get_groups()
+    def score_group(group):
+        """Group entry with its average similarity (None if no scored pair)."""
+        group = sorted(group)
+        if sim_method == 'Bruteforce':
+            # every in-group pair was compared: a bit set in c of the K members differs in c·(K−c)
+            # pairs, so the pairwise distances add up from per-bit counts without listing the pairs
+            weights = multiplicity[group]
+            set_counts = weights @ unpack_bits(hashes[group])
+            total = int(weights.sum())
+            mean_distance = float((set_counts * (total - set_counts)).sum()) / (total * (total - 1) // 2)
+            avg_similarity = distance_to_similarity(mean_distance, hash_bits)
+        else:
+            # components are labelled by their smallest id
+            if not edge_counts[group[0]]:
+                return None
+            avg_similarity = edge_sums[group[0]] / edge_counts[group[0]]
+        return {
+            'group': [name for idx in group for name in [names[idx]] + copies.get(idx, [])],
+            'avg_similarity': round(avg_similarity, 2)
+        }
     
     group_scores = []
-    for group in duplicate_groups:
-        n = len(group)
-        if n < 2:
-            continue
-        
-        pairwise_scores = []
-        for i in range(n):
-            for j in range(i+1, n):
-                img1, img2 = group[i], group[j]
-                score = (similarity_matrix.get((img1, img2)) or
-                        similarity_matrix.get((img2, img1)))
-                if score:
-                    pairwise_scores.append(score)
+    grouped = set()
+    # open groups: root -> member ids and root -> largest member, plus a heap of
+    # (largest member, root) to spot final groups
+    members = {}
+    largest_member = {}
+    pending = []
+    
+    def merge(i, j):
+        root1, root2 = unionf.find(i), unionf.find(j)
+        if root1 == root2:
+            return
+        root = unionf.union(root1, root2)
+        other = root2 if root == root1 else root1
+        merged = members.pop(root, [root])
+        absorbed = members.pop(other, [other])
+        if len(merged) < len(absorbed):
+            merged, absorbed = absorbed, merged
+        merged.extend(absorbed)
+        members[root] = merged
+        largest = max(largest_member.pop(root, root), largest_member.pop(other, other))
+        largest_member[root] = largest
+        heapq.heappush(pending, (largest, root))
+    
+    def finalize(row_end):
+        """Pop every open group whose members are all below row_end: no later edge can touch it."""
+        while pending and pending[0][0] < row_end:
+            largest, root = heapq.heappop(pending)
+            if largest_member.get(root) != largest:
+                continue
+            del largest_member[root]
+            group = members.pop(root)
+            yield from emit(group)
+    
+    def emit(group):
+        grouped.update(group)
+        with timer.stage('scoring'):
+            entry = score_group(group)
+        if entry is not None:
+            group_scores.append(entry)
+            yield {'event': 'group', **entry}
+    
+    comparison_time = {'Bruteforce': 0, 'lsh': 0, 'exact': 0}
+    lsh_layout = None
+    start_time = time.time()
+    
+    if sim_method == 'Bruteforce' and edges is None:
+        next_report = 0
+        for row_end, edge_i, edge_j, edge_dist in timer.timed(iter_bruteforce_pairs(hashes, max_distance), 'compare'):
+            edge_chunks.append((edge_i, edge_j, edge_dist))
+            with timer.stage('grouping'):
+                for i, j in zip(edge_i.tolist(), edge_j.tolist()):
+                    merge(i, j)
+            comparison_count = max_possible_comparisons - (n_images - row_end) * (n_images - row_end - 1) // 2
+            comparison_time[sim_method] = time.time() - start_time
+            yield from finalize(row_end)
+            if comparison_count >= next_report:
+                yield {'event': 'compared', 'done': comparison_count, 'total': max_possible_comparisons}
+                next_report = comparison_count + max_possible_comparisons // 100
+    
+    else:
+        if edges is not None:
+            edge_i, edge_j, edge_dist = (np.asarray(column) for column in edges)
+            keep = edge_dist <= max_distance
+            edge_i, edge_j, edge_dist = edge_i[keep], edge_j[keep], edge_dist[keep]
+        elif sim_method == 'lsh':
+            with timer.stage('tuning'):
+                lsh_layout = plan_lsh(hashes, max_distance, num_bands, rows_per_band, multiprobe, target_recall,
+                                      hash_bits)
+                lsh = LSH(band_widths=lsh_layout['band_widths'], multiprobe=lsh_layout['multiprobe'],
+                          hash_bits=hash_bits)
+            yield {'event': 'lsh_layout', **lsh_layout}
+            if sharded:
+                # index, candidates and compare all run inside the shard workers
+                with timer.stage('candidates'):
+                    (edge_i, edge_j, edge_dist), shard_stats = run_shards(
+                        hashes, max_distance, shards, workers, sim_method='lsh', band_widths=lsh.band_widths,
+                        multiprobe=lsh.multiprobe)
+                comparison_count = shard_stats['candidates']
+                yield {'event': 'candidates', 'pairs': comparison_count}
+            else:
+                with timer.stage('index'):
+                    lsh.index(hashes)
+                with timer.stage('candidates'):
+                    cand_i, cand_j = lsh.candidate_pairs()
+                comparison_count = len(cand_i)
+                yield {'event': 'candidates', 'pairs': comparison_count}
+                with timer.stage('compare'):
+                    cand_dist = hamming_distance(hashes[cand_i], hashes[cand_j])
+                    keep = cand_dist <= max_distance
+                    edge_i, edge_j, edge_dist = cand_i[keep], cand_j[keep], cand_dist[keep]
+        elif sharded:
+            with timer.stage('candidates'):
+                (edge_i, edge_j, edge_dist), shard_stats = run_shards(hashes, max_distance, shards, workers,
+                                                                      sim_method='exact')
+            comparison_count = shard_stats['candidates']
+            yield {'event': 'candidates', 'pairs': comparison_count}
+        else:
+            with timer.stage('index'):
+                mih = MultiIndexHash(max_distance).build(hashes)
+            # probing verifies candidates on the full hash as it goes: compare is part of this stage
+            with timer.stage('candidates'):
+                edge_i, edge_j, edge_dist = mih.pairs()
+            comparison_count = mih.candidates_checked
+            yield {'event': 'candidates', 'pairs': comparison_count}
+        edge_chunks.append((edge_i, edge_j, edge_dist))
         
-        if pairwise_scores:
-            avg_similarity = np.mean([s['similarity'] for s in pairwise_scores])
-            group_scores.append({
-                'group': group,
-                'avg_similarity': round(avg_similarity, 2)
-            })
-    
-    max_possible_comparisons = len(image_names) * (len(image_names) - 1) // 2
+        # all edges are known at once: group them in one connected-components pass
+        with timer.stage('grouping'):
+            labels = connected_components(n_images, edge_i, edge_j)
+            components = component_groups(labels)
+        if sim_method != 'Bruteforce':
+            with timer.stage('scoring'):
+                edge_labels = labels[edge_i]
+                # an edge stands for every pair between the copies of its two ends; copies among
+                # themselves add pairs at 100%
+                pair_weights = (multiplicity[edge_i] * multiplicity[edge_j]).astype(np.float64)
+                copy_pairs = (multiplicity * (multiplicity - 1) / 2).astype(np.float64)
+                edge_similarity = distance_to_similarity(edge_dist.astype(np.float64), hash_bits)
+                edge_sums = (np.bincount(edge_labels, weights=edge_similarity * pair_weights, minlength=n_images)
+                             + np.bincount(labels, weights=100.0 * copy_pairs, minlength=n_images))
+                edge_counts = (np.bincount(edge_labels, weights=pair_weights, minlength=n_images)
+                               + np.bincount(labels, weights=copy_pairs, minlength=n_images))
+        comparison_time[sim_method] = time.time() - start_time
+        yield {'event': 'compared', 'done': comparison_count, 'total': comparison_count}
+        for group in components:
+            yield from emit(group.tolist())
+    
+    yield from finalize(n_images)
+    # files whose only duplicates are byte-identical copies
+    for pos in sorted(copies):
+        if pos not in grouped:
+            yield from emit([pos])
+    edges = tuple(np.concatenate(parts) for parts in zip(*edge_chunks)) if edge_chunks else _empty_edges()
+    
     reduction_pct = 100 * (1 - comparison_count / max_possible_comparisons) if max_possible_comparisons > 0 else 0
     
     stats = {
         'method': sim_method,
-        'total_images': len(image_names),
-        'comparison_time_brute': round(comparison_time_brute, 4),
-        'comparison_time_lsh': round(comparison_time_lsh, 4),
+        'total_images': int(multiplicity.sum()),
+        'hash_bits': hash_bits,
+        'comparison_time_brute': round(comparison_time['Bruteforce'], 4),
+        'comparison_time_lsh': round(comparison_time['lsh'], 4),
+        'comparison_time_exact': round(comparison_time['exact'], 4),
         'comparisons_made': comparison_count,
         'max_possible_comparisons': max_possible_comparisons,
         'comparison_reduction': round(reduction_pct, 1),
-        'duplicate_groups_found': len(group_scores)
+        'duplicate_groups_found': len(group_scores),
     }
+    if lsh_layout is not None:
+        stats.update({f'lsh_{key}': value for key, value in lsh_layout.items()})
+    if sharded:
+        stats['shards'] = shards
+    if owns_timer:
+        stats['stage_times'] = {stage: round(seconds, 4) for stage, seconds in timer.times.items()}
+        timer.report(stats)
     
-    return group_scores, len(group_scores), stats
+    yield {'event': 'done', 'groups': group_scores, 'stats': stats, 'edges': edges, 'names': names, 'hashes': hashes}
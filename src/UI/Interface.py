@@ -6,13 +6,15 @@ import shutil
 import numpy as np
 import sys
 import zipfile
-import io
 import tempfile
 import time
+import hashlib
 
 project_root = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(project_root))
-from src.Feature_Extractions import find_duplicates
+from src.Feature_Extractions import (find_duplicates, iter_duplicates, iter_groups, plan_lsh, zip_sources,
+                                     copy_zip_members)
+from src.utils import threshold_to_max_distance
 
 
 hide_streamlit_style = """
@@ -109,6 +111,13 @@ if 'uploader_key' not in st.session_state:
     st.session_state.uploader_key = 0
 if 'stats' not in st.session_state:
     st.session_state.stats = None
+if 'hashed' not in st.session_state:
+    st.session_state.hashed = None
+
+# stats that describe hashing rather than grouping, kept with the cached hashes
+HASH_STAT_KEYS = ('hashing_time', 'errors', 'decodes_avoided', 'files_digested', 'decode_latency', 'bytes_read')
+# stats of the comparisons that found a set of edges, kept with the cached edges
+COMPARISON_STAT_KEYS = ('comparisons_made', 'comparison_reduction')
 
 
 def save_uploaded_files(uploaded_files):
@@ -137,6 +146,18 @@ def save_uploaded_files(uploaded_files):
     
     return temp_dir
 
+def upload_set_key(uploaded_files, *settings):
+    """Content digest of an upload set (file names and bytes) and the hashing settings"""
+    file_digests = sorted(
+        (uploaded_file.name, hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest())
+        for uploaded_file in uploaded_files
+    )
+    return hashlib.blake2b(repr((file_digests, settings)).encode(), digest_size=16).hexdigest()
+
+def lsh_edge_key(layout):
+    """Edge cache key of an LSH layout: its candidate pairs depend only on the bands and probing"""
+    return ('lsh', tuple(layout['band_widths']), layout['multiprobe'])
+
 def get_similarity_badge_class(similarity):
     """Get CSS class based on similarity score"""
     if similarity >= 90:
@@ -165,64 +186,40 @@ def calculate_space_wasted(duplicate_groups, temp_dir):
     return total_wasted
 
 
-def process_zip_folder(uploaded_zip, algorithm, threshold, sim_method, num_bands, rows_per_band):
+def process_zip_folder(uploaded_zip, algorithm, threshold, sim_method, num_bands, rows_per_band, workers=None,
+                       fast_decode=False, multiprobe=False, target_recall=0.95, hash_bits=64):
     """Process ZIP folder and return filtered ZIP"""
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            extract_path = temp_path / "extracted"
-            filtered_path = temp_path / "filtered"
-            extract_path.mkdir()
-            filtered_path.mkdir()
-            
-            # Extract ZIP
-            with zipfile.ZipFile(io.BytesIO(uploaded_zip.read())) as zip_ref:
-                zip_ref.extractall(extract_path)
-            
-            image_extensions = {'.png', '.jpg', '.jpeg'}
-            image_files = []
-            seen_files = set()
+        # Hash members straight from the archive: no extraction, no copy of the upload
+        with zipfile.ZipFile(uploaded_zip) as zip_ref:
+            image_members = list(zip_sources(zip_ref))
             
-            for file_path in extract_path.rglob('*'):
-                if file_path.is_file() and file_path.suffix.lower() in image_extensions:
-                    abs_path = file_path.resolve()
-                    if abs_path not in seen_files:
-                        image_files.append(file_path)
-                        seen_files.add(abs_path)
+            if not image_members:
+                return None, "No images found in the ZIP file!", 0, 0, 0, []
             
-            if not image_files:
-                return None, "No images found in the ZIP file!", 0, 0, 0
-            
-            
-            
-            # Create a flat temp folder for find_duplicates
-            flat_temp = temp_path / "flat_temp"
-            flat_temp.mkdir()
-            
-            file_mapping = {}
-            for idx, img_file in enumerate(image_files):
-                # Create unique flat name
-                flat_name = f"{idx}_{img_file.name}"
-                flat_path = flat_temp / flat_name
-                shutil.copy2(img_file, flat_path)
-                file_mapping[flat_name] = img_file
-            
-            # Find duplicates in flat folder
             result = find_duplicates(
-                str(flat_temp), 
+                image_members, 
                 algorithm, 
                 threshold,
                 sim_method=sim_method,
                 num_bands=num_bands,
-                rows_per_band=rows_per_band
+                rows_per_band=rows_per_band,
+                workers=workers,
+                fast_decode=fast_decode,
+                multiprobe=multiprobe,
+                target_recall=target_recall,
+                hash_bits=hash_bits
             )
             
+            hash_errors = []
             if not result or result == []:
                 duplicates = []
                 num_groups = 0
             elif isinstance(result, tuple) and len(result) >= 2:
                 duplicates = result[0]
                 num_groups = result[1]
+                if len(result) == 3 and result[2]:
+                    hash_errors = result[2].get('errors', [])
             else:
                 duplicates = result if isinstance(result, list) else []
                 num_groups = len(duplicates)
@@ -230,36 +227,23 @@ def process_zip_folder(uploaded_zip, algorithm, threshold, sim_method, num_bands
             files_to_remove = set()
             if duplicates:
                 for group_data in duplicates:
-                    dup_group = group_data['group']
-
-                    original_paths = [file_mapping[flat_name] for flat_name in dup_group]
-                    
-                    files_to_remove.update(original_paths[1:])
+                    files_to_remove.update(group_data['group'][1:])
             
-            kept_files = 0
+            kept_members = [name for name, _ in image_members if name not in files_to_remove]
             removed_files = len(files_to_remove)
             
-            for img_file in image_files:
-                if img_file not in files_to_remove:
-                    relative_path = img_file.relative_to(extract_path)
-                    dest_file = filtered_path / relative_path
-                    dest_file.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(img_file, dest_file)
-                    kept_files += 1
-            
-            # Create ZIP of filtered folder
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for file_path in filtered_path.rglob('*'):
-                    if file_path.is_file():
-                        arcname = file_path.relative_to(filtered_path)
-                        zip_file.write(file_path, arcname)
-            
+            # Copy the kept members, still compressed, into an on-disk ZIP; the caller closes it
+            zip_buffer = tempfile.TemporaryFile(buffering=0)
+            try:
+                copy_zip_members(zip_ref, kept_members, zip_buffer)
+            except Exception:
+                zip_buffer.close()
+                raise
             zip_buffer.seek(0)
-            return zip_buffer, None, len(image_files), removed_files, kept_files
+            return zip_buffer, None, len(image_members), removed_files, len(kept_members), hash_errors
             
     except Exception as e:
-        return None, f"Error processing folder: {str(e)}", 0, 0, 0
+        return None, f"Error processing folder: {str(e)}", 0, 0, 0, []
 
 
 with st.sidebar:
@@ -269,27 +253,60 @@ with st.sidebar:
     
     sim_method = st.radio(
         "Choose method:",
-        options=['Bruteforce', 'lsh'],
+        options=['Bruteforce', 'lsh', 'exact'],
         format_func=lambda x: {
             'Bruteforce': 'Bruteforce',
-            'lsh': 'LSH'
+            'lsh': 'LSH',
+            'exact': 'Exact Index'
         }[x],
     )
+    
+    hash_bits = st.selectbox(
+        "Hash Size (bits)",
+        options=[64, 128, 256],
+        help="Longer hashes tell apart near-identical scenes (e.g. similar rooms) at a higher comparison cost.",
+    )
+    
     num_bands=8
     rows_per_band=8
+    multiprobe=False
+    target_recall=0.95
     if sim_method == 'lsh':
         with st.expander("⚙️ LSH Settings", expanded=False):
-            valid_bands = [1, 2, 4, 8, 16, 32, 64]
-            
-            num_bands = st.select_slider(
-                "Number of Bands",
-                options=valid_bands,
-                value=8
+            auto_tune = st.checkbox(
+                "Auto-tune bands",
+                value=True,
+                help="Pick bands and rows from the similarity threshold and a sample of the hashes.",
             )
             
-            rows_per_band = 64 // num_bands
+            if auto_tune:
+                num_bands = 'auto'
+                target_recall = st.slider(
+                    "Target Recall",
+                    min_value=0.5,
+                    max_value=1.0,
+                    value=0.95,
+                    step=0.01,
+                )
+            else:
+                # bands are at most 64 bits wide
+                valid_bands = [hash_bits // rows for rows in (64, 32, 16, 8, 4, 2, 1)]
+                
+                num_bands = st.select_slider(
+                    "Number of Bands",
+                    options=valid_bands,
+                    value=8
+                )
+                
+                rows_per_band = hash_bits // num_bands
+                
+                st.caption(f"Hash size: {num_bands * rows_per_band} bits ({num_bands} bands × {rows_per_band} rows/band)")
             
-            st.caption(f"Hash size: {num_bands * rows_per_band} bits ({num_bands} bands × {rows_per_band} rows/band)")
+            multiprobe = st.checkbox(
+                "Multi-probe",
+                value=False,
+                help="Also check buckets one bit away: better recall for the same number of bands.",
+            )
 
     
     algorithm = st.selectbox(
@@ -305,12 +322,34 @@ with st.sidebar:
         step=5,
     )
     
+    fast_decode = st.checkbox(
+        "Fast JPEG Decode",
+        value=False,
+        help="Decode JPEGs directly near the hash size. Much faster on large photos; hashes may drift by a bit or two.",
+    )
+    
+    skip_identical = st.checkbox(
+        "Skip Identical Copies",
+        value=True,
+        help="Hash byte-identical files only once and add the copies back to their group.",
+    )
+    
+    max_workers = os.cpu_count() or 1
+    workers = st.number_input(
+        "Hashing Workers",
+        min_value=1,
+        max_value=max_workers,
+        value=max_workers,
+        step=1,
+    )
+    
     st.markdown("---")
     
     if st.session_state.processed and st.button("Reset"):
         st.session_state.duplicates = []
         st.session_state.processed = False
         st.session_state.stats = {}
+        st.session_state.hashed = None
         st.session_state.uploader_key += 1
         if st.session_state.temp_dir and os.path.exists(st.session_state.temp_dir):
             shutil.rmtree(st.session_state.temp_dir)
@@ -347,39 +386,133 @@ with tab1:
             
             if st.button("Find Duplicates", type="primary", key="find_btn"):
                 try:
-                    temp_dir = save_uploaded_files(uploaded_files)
-                    st.session_state.temp_dir = temp_dir
+                    # same files and hashing settings as last time: keep the hashes and only regroup
+                    set_key = upload_set_key(uploaded_files, algorithm, hash_bits, fast_decode, skip_identical)
+                    hashed = st.session_state.hashed
+                    if hashed is None or hashed['key'] != set_key or not os.path.exists(st.session_state.temp_dir):
+                        hashed = st.session_state.hashed = None
+                        st.session_state.temp_dir = save_uploaded_files(uploaded_files)
+                    temp_dir = st.session_state.temp_dir
+                    reused = hashed is not None
+                    
+                    # edges found at a looser threshold contain every edge of a stricter one;
+                    # Bruteforce and exact both find all pairs, lsh only those of its layout, which
+                    # the auto-tuner picks per threshold: plan it first and reuse edges of the same one
+                    max_distance = threshold_to_max_distance(threshold, hash_bits)
+                    lsh_layout = None
+                    edge_key = 'exact'
+                    if reused and sim_method == 'lsh':
+                        lsh_layout = plan_lsh(hashed['hashes'], max_distance, num_bands, rows_per_band, multiprobe,
+                                              target_recall, hash_bits)
+                        edge_key = lsh_edge_key(lsh_layout)
+                    cached_edges = hashed['edges'].get(edge_key) if reused else None
+                    if cached_edges and cached_edges['max_distance'] < max_distance:
+                        cached_edges = None
                     
-                    with st.spinner("Analyzing images..."):
-                        result = find_duplicates(
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
+                    duplicates, stats = [], {}
+                    groups_so_far = 0
+                    
+                    if reused:
+                        progress_bar.progress(0.5)
+                        events = iter_groups(
+                            hashed['names'],
+                            hashed['hashes'],
+                            threshold,
+                            sim_method=sim_method,
+                            num_bands=num_bands,
+                            rows_per_band=rows_per_band,
+                            multiprobe=multiprobe,
+                            target_recall=target_recall,
+                            copies=hashed['copies'],
+                            edges=cached_edges['edges'] if cached_edges else None,
+                            hash_bits=hash_bits
+                        )
+                    else:
+                        events = iter_duplicates(
                             temp_dir,
                             algorithm,
                             threshold,
                             sim_method=sim_method,
                             num_bands=num_bands,
-                            rows_per_band=rows_per_band
+                            rows_per_band=rows_per_band,
+                            workers=workers,
+                            fast_decode=fast_decode,
+                            multiprobe=multiprobe,
+                            target_recall=target_recall,
+                            skip_identical=skip_identical,
+                            hash_bits=hash_bits
                         )
-                        
-                        if not result or result == []:
-                            duplicates = []
-                            num_groups = 0
-                            stats = {}
-                        elif isinstance(result, tuple) and len(result) == 3:
-                            duplicates, num_groups, stats = result
-                        elif isinstance(result, tuple) and len(result) == 2:
-                            duplicates, num_groups = result
-                            stats = {}
-                        else:
-                            duplicates = result if isinstance(result, list) else []
-                            num_groups = len(duplicates)
-                            stats = {}
-                        
-                        st.session_state.duplicates = duplicates
-                        st.session_state.total_files = len(uploaded_files)
-                        st.session_state.stats = stats
-                        st.session_state.processed = True
+                    
+                    for event in events:
+                        # hashing fills the first half of the bar, comparisons the second
+                        if event['event'] == 'discovered':
+                            status_text.text(f"Found {event['files']} images")
+                        elif event['event'] == 'hashed':
+                            progress_bar.progress(0.5 * event['done'] / event['total'])
+                            status_text.text(f"Hashing: {event['done']}/{event['total']} images")
+                        elif event['event'] == 'lsh_layout':
+                            status_text.text(f"LSH: {len(event['band_widths'])} bands, expected recall "
+                                             f"{event['expected_recall']:.1%}, "
+                                             f"~{event['expected_candidates']:,} candidate pairs")
+                        elif event['event'] == 'candidates':
+                            status_text.text(f"Comparing {event['pairs']:,} candidate pairs")
+                        elif event['event'] == 'compared':
+                            progress_bar.progress(0.5 + 0.5 * event['done'] / max(event['total'], 1))
+                            status_text.text(f"Compared {event['done']:,}/{event['total']:,} pairs "
+                                             f"- {groups_so_far} duplicate groups so far")
+                        elif event['event'] == 'group':
+                            groups_so_far += 1
+                        elif event['event'] == 'done':
+                            duplicates, stats = event['groups'], event['stats']
+                            if 'hashes' not in event:
+                                continue
+                            if reused:
+                                stats = {**hashed['stats'], **stats}
+                            else:
+                                hashed = st.session_state.hashed = {
+                                    'key': set_key,
+                                    'names': event['names'],
+                                    'hashes': event['hashes'],
+                                    'copies': event['copies'],
+                                    'stats': {key: stats[key] for key in HASH_STAT_KEYS if key in stats},
+                                    'edges': {},
+                                }
+                            if cached_edges:
+                                # no comparisons ran: report those that found the cached edges
+                                stats.update({key: cached_edges[key] for key in COMPARISON_STAT_KEYS})
+                                if lsh_layout is not None:
+                                    stats.update({f'lsh_{key}': value for key, value in lsh_layout.items()})
+                            else:
+                                if sim_method == 'lsh':
+                                    edge_key = lsh_edge_key({'band_widths': stats['lsh_band_widths'],
+                                                             'multiprobe': stats['lsh_multiprobe']})
+                                hashed['edges'][edge_key] = {
+                                    'max_distance': max_distance,
+                                    'edges': event['edges'],
+                                    **{key: stats[key] for key in COMPARISON_STAT_KEYS},
+                                }
+                    
+                    progress_bar.empty()
+                    status_text.empty()
+                    
+                    st.session_state.duplicates = duplicates
+                    st.session_state.total_files = len(uploaded_files)
+                    st.session_state.stats = stats
+                    st.session_state.processed = True
                     
                     st.success("✨ Processing complete!")
+                    if reused:
+                        st.caption("Same images as the last run: reused their hashes"
+                                   + (" and candidate pairs" if cached_edges else ""))
+                    if stats.get('decodes_avoided'):
+                        st.caption(f"{stats['decodes_avoided']} byte-identical copies were not decoded again")
+                    
+                    if stats and stats.get('errors'):
+                        with st.expander(f"⚠️ {len(stats['errors'])} files could not be processed"):
+                            for err in stats['errors']:
+                                st.caption(f"{err['file']}: {err['error']}")
                     
                     # Display performance stats if available
                     with col1:
@@ -391,16 +524,27 @@ with tab1:
                             with col1:
                                 st.metric("Method", stats['method'])
                             with col2:
-                                time_val = stats.get(
-                                    'comparison_time_lsh' if stats['method'] == 'lsh' else 'comparison_time_brute',
-                                    0
-                                )
+                                time_val = stats.get({
+                                    'lsh': 'comparison_time_lsh',
+                                    'exact': 'comparison_time_exact'
+                                }.get(stats['method'], 'comparison_time_brute'), 0)
                                 if time_val < 0.01:
                                     st.metric("Total Time", f"{time_val*1000:.2f}ms")
                                 else:
                                     st.metric("Total Time", f"{time_val:.4f}s")
                             with col3:
                                 st.metric("Comparisons", f"{stats['comparisons_made']:,}")
+                            if 'lsh_expected_recall' in stats:
+                                with col4:
+                                    st.metric("Expected Recall", f"{stats['lsh_expected_recall']:.1%}",
+                                              help=f"Band widths: {stats['lsh_band_widths']}")
+                            
+                            with st.expander("Stage timings"):
+                                st.json({
+                                    'stage_times': stats.get('stage_times', {}),
+                                    'decode_latency': stats.get('decode_latency', {}),
+                                    'bytes_read': stats.get('bytes_read', 0),
+                                })
                         
                 except Exception as e:
                     st.error(f"❌ Error: {str(e)}")
@@ -507,36 +651,44 @@ with tab2:
         
         if st.button("Filter Folder", type="primary", key="filter_btn"):
             with st.spinner("🔄 Processing folder... This may take a moment."):
-                zip_buffer, error, total_images, removed, kept = process_zip_folder(
-                    uploaded_zip, algorithm, threshold, sim_method, num_bands, rows_per_band
+                zip_buffer, error, total_images, removed, kept, hash_errors = process_zip_folder(
+                    uploaded_zip, algorithm, threshold, sim_method, num_bands, rows_per_band, workers, fast_decode,
+                    multiprobe, target_recall, hash_bits
                 )
                 
                 if error:
                     st.error(f"❌ {error}")
                 else:
-                    with col2:
-                        st.success("✨ Processing complete!")
-                    st.markdown("---")
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric("📸 Original Images", total_images)
-                    with col2:
-                        st.metric("🗑️ Duplicates Removed", removed)
-                    with col3:
-                        st.metric("✅ Images Kept", kept)
+                    # download_button reads the file right away: close it once the page is built
+                    with zip_buffer:
+                        with col2:
+                            st.success("✨ Processing complete!")
+                        st.markdown("---")
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("📸 Original Images", total_images)
+                        with col2:
+                            st.metric("🗑️ Duplicates Removed", removed)
+                        with col3:
+                            st.metric("✅ Images Kept", kept)
+                    
+                        if hash_errors:
+                            with st.expander(f"⚠️ {len(hash_errors)} files could not be processed"):
+                                for err in hash_errors:
+                                    st.caption(f"{err['file']}: {err['error']}")
                     
-                    if removed > 0:
-                        reduction_pct = (removed / total_images) * 100
-                        st.info(f"💾 Space saved: {reduction_pct:.1f}% reduction in image count")
+                        if removed > 0:
+                            reduction_pct = (removed / total_images) * 100
+                            st.info(f"💾 Space saved: {reduction_pct:.1f}% reduction in image count")
                     
-                    st.download_button(
-                        label="📥 Download Filtered Folder",
-                        data=zip_buffer,
-                        file_name=f"filtered_{uploaded_zip.name}",
-                        mime="application/zip",
-                        type="primary",
-                        use_container_width=True
-                    )
+                        st.download_button(
+                            label="📥 Download Filtered Folder",
+                            data=zip_buffer,
+                            file_name=f"filtered_{uploaded_zip.name}",
+                            mime="application/zip",
+                            type="primary",
+                            use_container_width=True
+                        )
     else:
         st.info("📤 Upload a ZIP file to get started")
 
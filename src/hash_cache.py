@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Streaming BLAKE2b digest of a file's bytes."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """
+    Persistent SQLite cache of image hashes keyed by file identity.
+
+    Entries are keyed by (path, size, mtime) together with the hash algorithm
+    and its parameters, so changing either invalidates old hashes. With
+    use_digest=True the key is the file's content digest instead, which also
+    survives touches, renames and re-uploads of identical bytes.
+    Hashes are stored as little-endian 64-bit words, one per 64 bits of hash.
+    The least recently used entries are evicted once max_entries is exceeded.
+    """
+
+    def __init__(self, db_path, max_entries=1_000_000, use_digest=False):
+        self.db_path = str(db_path)
+        self.max_entries = max_entries
+        self.use_digest = use_digest
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._identities = {}
+
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                key TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                params TEXT NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                hash BLOB NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (key, algorithm, params)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS hashes_lru ON hashes (last_used)")
+        self._clock = self._conn.execute("SELECT COALESCE(MAX(last_used), 0) FROM hashes").fetchone()[0]
+
+    def _identity(self, path, stat=None):
+        """Cache key, size and mtime for a file. stat may pass an already known (size, mtime_ns)."""
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_size, st.st_mtime_ns)
+        key = file_digest(path) if self.use_digest else os.path.abspath(path)
+        return (key,) + tuple(stat)
+
+    def lookup(self, paths, algorithm, params, stats=None):
+        """
+        Look up cached hashes for files.
+        stats: optional (size, mtime_ns) per path, e.g. from os.scandir, to skip re-stat'ing
+        Returns:
+            List aligned with paths holding the cached hash, or None on a miss
+        """
+        params = json.dumps(params, sort_keys=True)
+        self._clock += 1
+        results, used = [], []
+
+        for path, stat in zip(paths, stats if stats is not None else [None] * len(paths)):
+            key, size, mtime_ns = identity = self._identity(path, stat)
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, hash FROM hashes WHERE key = ? AND algorithm = ? AND params = ?",
+                (key, algorithm, params)
+            ).fetchone()
+
+            if row is not None and (self.use_digest or (row[0], row[1]) == (size, mtime_ns)):
+                words = np.frombuffer(row[2], dtype='<u8').astype(np.uint64)
+                results.append(words[0] if len(words) == 1 else words)
+                used.append((self._clock, key, algorithm, params))
+                self.hits += 1
+            else:
+                results.append(None)
+                self._identities[path] = identity
+                self.misses += 1
+
+        self._conn.executemany(
+            "UPDATE hashes SET last_used = ? WHERE key = ? AND algorithm = ? AND params = ?", used
+        )
+        self._conn.commit()
+        return results
+
+    def store(self, paths, hashes, algorithm, params):
+        """Store freshly computed hashes, then evict down to max_entries."""
+        params = json.dumps(params, sort_keys=True)
+        self._clock += 1
+        rows = []
+        for path, image_hash in zip(paths, hashes):
+            if image_hash is None:
+                continue
+            key, size, mtime_ns = self._identities.pop(path, None) or self._identity(path)
+            blob = np.asarray(image_hash, dtype='<u8').tobytes()
+            rows.append((key, algorithm, params, size, mtime_ns, blob, self._clock))
+
+        self._conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries beyond max_entries."""
+        count = len(self)
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM hashes WHERE rowid IN "
+                "(SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+
+    def stats(self, since=None):
+        """
+        Hit/miss counters for reporting.
+        since: an earlier stats() result; counters are then reported as the change since it,
+        e.g. for one run of a cache instance that is reused across runs
+        """
+        since = since or {}
+        return {
+            'cache_hits': self.hits - since.get('cache_hits', 0),
+            'cache_misses': self.misses - since.get('cache_misses', 0),
+            'cache_evictions': self.evictions - since.get('cache_evictions', 0),
+            'cache_entries': len(self),
+        }
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,174 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.utils import HASH_BITS, WORD_BITS, hash_bits_of
+
+STORE_FORMAT = 1
+
+# files of a store directory
+_META = 'meta.json'
+_HASHES = 'hashes.u64'
+_NAMES = 'names.bin'
+_OFFSETS = 'names.idx'
+
+
+def encode_names(names, start=0):
+    """
+    Names as one UTF-8 blob plus the int64 end offset of every name in it, counted from start.
+    Returns: (blob bytes, offsets array)
+    """
+    encoded = [name.encode('utf-8') for name in names]
+    return b''.join(encoded), start + np.cumsum([len(name) for name in encoded], dtype=np.int64)
+
+
+def decode_names(blob, offsets, ids=None):
+    """
+    Names of a name table: blob as a uint8 array, offsets with the leading 0 (count + 1 of them).
+    ids: the names to decode (all of them by default)
+    """
+    if ids is None:
+        if len(offsets) < 2:
+            return []
+        text = bytes(blob).decode('utf-8')
+        # byte offsets are character offsets only for ASCII tables; otherwise decode name by name
+        if len(text) == len(blob):
+            bounds = np.asarray(offsets).tolist()
+            return [text[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        ids = range(len(offsets) - 1)
+    return [bytes(blob[offsets[idx]:offsets[idx + 1]]).decode('utf-8') for idx in ids]
+
+
+class HashStoreWriter:
+    """
+    Streams names and packed hashes into a new store directory, chunk by chunk.
+    meta.json is written last on close(), so an interrupted write never opens as a store.
+    """
+
+    def __init__(self, path, hash_bits=HASH_BITS, metadata=None):
+        if hash_bits % WORD_BITS:
+            raise ValueError(f"Hash size must be a multiple of {WORD_BITS} bits, got {hash_bits}")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / _META).unlink(missing_ok=True)
+        self.hash_bits = hash_bits
+        self.metadata = metadata or {}
+        self.count = 0
+        self._name_bytes = 0
+        self._hashes = open(self.path / _HASHES, 'wb')
+        self._names = open(self.path / _NAMES, 'wb')
+        self._offsets = open(self.path / _OFFSETS, 'wb')
+        np.zeros(1, dtype='<i8').tofile(self._offsets)
+
+    def add(self, names, hashes):
+        """Append names with their packed hashes ((N,) or (N, W) uint64, matching hash_bits)."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(names) != len(hashes):
+            raise ValueError(f"Got {len(names)} names for {len(hashes)} hashes")
+        if not len(names):
+            return
+        if hash_bits_of(hashes) != self.hash_bits:
+            raise ValueError(f"Store holds {self.hash_bits}-bit hashes, got {hash_bits_of(hashes)}-bit ones")
+
+        blob, offsets = encode_names(names, self._name_bytes)
+        self._names.write(blob)
+        offsets.astype('<i8').tofile(self._offsets)
+        np.ascontiguousarray(hashes, dtype='<u8').tofile(self._hashes)
+        self._name_bytes = int(offsets[-1])
+        self.count += len(names)
+
+    def close(self):
+        for f in (self._hashes, self._names, self._offsets):
+            f.close()
+        meta = {
+            'format': STORE_FORMAT,
+            'count': self.count,
+            'hash_bits': self.hash_bits,
+            'metadata': self.metadata,
+        }
+        with open(self.path / _META, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HashStore:
+    """
+    Read-only columnar store of image names and packed hashes, memory-mapped from disk.
+
+    A store is a directory holding:
+        hashes.u64   contiguous little-endian uint64 hashes, one row of words per image
+        names.bin    UTF-8 names, back to back
+        names.idx    int64 offsets of every name in names.bin (count + 1 of them)
+        meta.json    count, hash size and free-form metadata
+
+    Opening maps the files instead of reading them: store.hashes is an np.memmap the
+    Bruteforce, LSH and exact engines use as is, and every process opening the same
+    store shares one copy through the page cache. Pickling a store (e.g. to send it to
+    worker processes) sends its path, not its contents.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        meta_path = self.path / _META
+        if not meta_path.exists():
+            raise FileNotFoundError(f"No hash store at {path} (missing {_META})")
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['format'] != STORE_FORMAT:
+            raise ValueError(f"Unsupported hash store format {meta['format']} (expected {STORE_FORMAT})")
+
+        self.count = meta['count']
+        self.hash_bits = meta['hash_bits']
+        self.metadata = meta['metadata']
+        words = self.hash_bits // WORD_BITS
+        shape = (self.count,) if words == 1 else (self.count, words)
+        self.hashes = _map(self.path / _HASHES, '<u8', shape)
+        self._offsets = _map(self.path / _OFFSETS, '<i8', (self.count + 1,))
+        self._names = _map(self.path / _NAMES, np.uint8, (int(self._offsets[-1]),))
+
+    @classmethod
+    def create(cls, path, hash_bits=HASH_BITS, metadata=None):
+        """Writer for a new store at path (see HashStoreWriter); use as a context manager."""
+        return HashStoreWriter(path, hash_bits, metadata)
+
+    @classmethod
+    def write(cls, path, names, hashes, metadata=None, hash_bits=None):
+        """
+        Write names and their packed hashes as a new store at path and open it.
+        hash_bits: taken from the shape of hashes if not given (an empty (N,) array reads as 64 bits)
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hash_bits is None:
+            hash_bits = hash_bits_of(hashes)
+        with HashStoreWriter(path, hash_bits, metadata) as writer:
+            writer.add(names, hashes)
+        return cls(path)
+
+    def __len__(self):
+        return self.count
+
+    def name(self, idx):
+        """Name of image idx, decoded from the mapped name table."""
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        return bytes(self._names[start:end]).decode('utf-8')
+
+    def names(self, ids=None):
+        """Names of the given image ids (all images by default)."""
+        return decode_names(self._names, self._offsets, ids)
+
+    def __reduce__(self):
+        return (HashStore, (str(self.path),))
+
+
+def _map(path, dtype, shape):
+    """Read-only memmap of a store file; empty files (empty stores) get an empty array."""
+    if not np.prod(shape) or not os.path.getsize(path):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
@@ -0,0 +1,400 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from src.Feature_Extractions import hash_images, iter_hash_sources
+from src.hash_store import HashStore, decode_names, encode_names
+from src.utils import LSH, MultiIndexHash, hamming_distance, threshold_to_max_distance, HASH_BITS, WORD_BITS
+
+
+class _StoreNames:
+    """
+    Image names of an index opened from a HashStore: stored names are decoded from the
+    mapped name table on access (see HashStore.name), names added since are kept in a list.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._stored = len(store)
+        self._added = []
+
+    def __len__(self):
+        return self._stored + len(self._added)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < self._stored:
+            return self._store.name(idx)
+        return self._added[idx - self._stored]
+
+    def __iter__(self):
+        for start in range(0, self._stored, 65536):
+            yield from self._store.names(range(start, min(start + 65536, self._stored)))
+        yield from self._added
+
+    def extend(self, names):
+        self._added.extend(names)
+
+
+class DuplicateIndex:
+    """
+    Incremental, persistent duplicate index.
+
+    Keeps image names, packed hashes, verified duplicate edges and group
+    membership between runs, so ingesting a batch only hashes the new files
+    and queries them against what is already indexed.
+
+    How it works:
+    1. Hashes live in segments, each with its own exact (MultiIndexHash) or LSH index
+    2. A new batch becomes a new segment: it is self-joined, then queried
+       against the older segments
+    3. Segments of similar size are merged (like a binary counter), so each
+       image is re-indexed O(log N) times overall
+    4. Groups are merged on every new edge and only the affected groups are
+       re-split when images are removed
+
+    query() / query_images() rank the indexed images nearest to new hashes or
+    images without adding them, e.g. to check uploads against a library.
+
+    hash_params may set 'hash_bits' for hashes wider than 64 bits; they are then
+    kept as (N, hash_bits // 64) word rows.
+    """
+
+    def __init__(self, threshold=85, algorithm='phash', sim_method='exact', num_bands=8, rows_per_band=8,
+                 multiprobe=False, hash_params=None):
+        if sim_method not in ('exact', 'lsh'):
+            raise ValueError(f"Invalid sim_method: {sim_method}. Use 'lsh' or 'exact'")
+
+        self.threshold = threshold
+        self.algorithm = algorithm
+        self.sim_method = sim_method
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.multiprobe = multiprobe
+        self.hash_params = hash_params if hash_params is not None else {'hash_size': 32}
+        self.hash_bits = self.hash_params.get('hash_bits', HASH_BITS)
+        self.max_distance = threshold_to_max_distance(threshold, self.hash_bits)
+        # one uint64 per hash, or a row of words for wider hashes
+        self._hash_shape = () if self.hash_bits == HASH_BITS else (self.hash_bits // WORD_BITS,)
+
+        self.names = []
+        self._name_to_id = {}        # name -> id of live images; None until needed for an opened store
+        self._hash_buf = np.empty((1024,) + self._hash_shape, dtype=np.uint64)
+        self._alive_buf = np.zeros(1024, dtype=bool)
+        self._segments = []          # [start, end, index] over consecutive id ranges
+        self.neighbors = {}          # id -> set of ids within threshold
+        self.group_id = {}           # id -> group key, only for images in a group
+        self.groups_by_id = {}       # group key -> set of member ids
+        self.errors = []
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    @property
+    def name_to_id(self):
+        """Id of every live image by name, built on first use for indexes opened from a store."""
+        if self._name_to_id is None:
+            self._name_to_id = {self.names[idx]: idx for idx in np.flatnonzero(self.alive).tolist()}
+        return self._name_to_id
+
+    @property
+    def hashes(self):
+        return self._hash_buf[:len(self.names)]
+
+    @property
+    def alive(self):
+        return self._alive_buf[:len(self.names)]
+
+    def config(self):
+        return {
+            'threshold': self.threshold,
+            'algorithm': self.algorithm,
+            'sim_method': self.sim_method,
+            'num_bands': self.num_bands,
+            'rows_per_band': self.rows_per_band,
+            'multiprobe': self.multiprobe,
+            'hash_params': self.hash_params,
+        }
+
+    def _build(self, start, end):
+        hashes = self.hashes[start:end]
+        if self.sim_method == 'lsh':
+            return LSH(self.num_bands, self.rows_per_band, multiprobe=self.multiprobe,
+                       hash_bits=self.hash_bits).index(hashes)
+        return MultiIndexHash(self.max_distance).build(hashes)
+
+    def _query(self, index, query_hashes, self_join=False, max_distance=None):
+        """Verified (query_idx, item_idx, distance) matches of query_hashes in one segment index."""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if self.sim_method == 'lsh':
+            q, item = index.candidate_pairs() if self_join else index.get_candidates(query_hashes)
+            dist = hamming_distance(query_hashes[q], index.hashes[item])
+            keep = dist <= max_distance
+            return q[keep], item[keep], dist[keep]
+        return index.pairs() if self_join else index.query(query_hashes, max_distance)
+
+    def _grow(self, count):
+        needed = len(self.names) + count
+        if needed > len(self._hash_buf):
+            capacity = max(needed, 2 * len(self._hash_buf))
+            hash_buf = np.empty((capacity,) + self._hash_shape, dtype=np.uint64)
+            alive_buf = np.zeros(capacity, dtype=bool)
+            hash_buf[:len(self.names)] = self.hashes
+            alive_buf[:len(self.names)] = self.alive
+            self._hash_buf, self._alive_buf = hash_buf, alive_buf
+
+    def add(self, images, workers=None, io_threads=None):
+        """
+        Hash and index new image files. Paths already in the index are skipped.
+        io_threads: read files ahead with this many threads (see hash_images)
+        Returns: List of ids assigned to the newly indexed images
+        """
+        paths = [str(path) for path in images if str(path) not in self.name_to_id]
+        hashes, errors = hash_images(paths, self.algorithm, workers=workers, io_threads=io_threads,
+                                     **self.hash_params)
+        self.errors.extend(errors)
+        ok = [idx for idx, image_hash in enumerate(hashes) if image_hash is not None]
+        return self.add_hashes([paths[idx] for idx in ok], [hashes[idx] for idx in ok])
+
+    def add_hashes(self, names, hashes):
+        """
+        Index precomputed packed hashes under the given names.
+        Returns: List of ids assigned to the new images
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64).reshape((-1,) + self._hash_shape)
+        if len(names) != len(hashes):
+            raise ValueError(f"Got {len(names)} names for {len(hashes)} hashes")
+        if not len(names):
+            return []
+
+        start = len(self.names)
+        self._grow(len(names))
+        self._hash_buf[start:start + len(names)] = hashes
+        self._alive_buf[start:start + len(names)] = True
+        if self._name_to_id is not None:
+            for offset, name in enumerate(names):
+                self._name_to_id[name] = start + offset
+        self.names.extend(names)
+        end = len(self.names)
+
+        segment = [start, end, self._build(start, end)]
+        q, item, _ = self._query(segment[2], hashes, self_join=True)
+        self._add_edges(q + start, item + start)
+        for seg_start, _, index in self._segments:
+            q, item, _ = self._query(index, hashes)
+            self._add_edges(q + start, item + seg_start)
+
+        self._segments.append(segment)
+        while (len(self._segments) > 1 and
+               self._segments[-2][1] - self._segments[-2][0] <= 2 * (self._segments[-1][1] - self._segments[-1][0])):
+            seg_start = self._segments[-2][0]
+            self._segments[-2:] = [[seg_start, end, self._build(seg_start, end)]]
+
+        return list(range(start, end))
+
+    def query(self, hashes, k=10, max_distance=None):
+        """
+        Rank the indexed images nearest to each query hash.
+        With sim_method='exact' every image within max_distance is considered; with
+        'lsh' only those sharing a bucket with the query, as for duplicate detection.
+
+        Args:
+            hashes: One packed hash or a batch of them
+            k: Results per query (None = all within max_distance)
+            max_distance: Largest Hamming distance returned (default: the index threshold's)
+        Returns:
+            One list per query of (id, distance) pairs, nearest first and ties by id
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64).reshape((-1,) + self._hash_shape)
+        found = [self._query(index, hashes, max_distance=max_distance) for _, _, index in self._segments]
+        found = [(q, item + seg_start, dist) for (seg_start, _, _), (q, item, dist) in zip(self._segments, found)]
+        if not found:
+            return [[] for _ in hashes]
+        q, item, dist = (np.concatenate(column) for column in zip(*found))
+        keep = self.alive[item]
+        q, item, dist = q[keep], item[keep], dist[keep]
+
+        order = np.lexsort((item, dist, q))
+        q, item, dist = q[order], item[order], dist[order]
+        bounds = np.searchsorted(q, np.arange(len(hashes) + 1))
+        if k is not None:
+            # rank of each match within its query's run
+            keep = np.arange(len(q)) - bounds[q] < k
+            q, item, dist = q[keep], item[keep], dist[keep]
+            bounds = np.searchsorted(q, np.arange(len(hashes) + 1))
+        pairs = list(zip(item.tolist(), dist.tolist()))
+        return [pairs[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])]
+
+    def query_images(self, images, k=10, max_distance=None, workers=None):
+        """
+        Hash images with the index's algorithm and rank the indexed images nearest to each (see query).
+        images: paths, file contents (bytes) or binary file objects, e.g. uploads held in memory
+        Returns:
+            (results, errors): one query result per image (None where it could not be
+            hashed) and (position, error message) pairs
+        """
+        images = list(images)
+        hashes, errors = [], []
+        for chunk_hashes, chunk_errors, _ in iter_hash_sources(enumerate(images), self.algorithm, workers=workers,
+                                                               **self.hash_params):
+            hashes.extend(chunk_hashes)
+            errors.extend(chunk_errors)
+        ok = [idx for idx, image_hash in enumerate(hashes) if image_hash is not None]
+        results = [None] * len(images)
+        for idx, matches in zip(ok, self.query([hashes[idx] for idx in ok], k, max_distance)):
+            results[idx] = matches
+        return results, errors
+
+    def _add_edges(self, ids1, ids2):
+        alive = self.alive
+        for a, b in zip(ids1.tolist(), ids2.tolist()):
+            if a == b or not (alive[a] and alive[b]):
+                continue
+            self.neighbors.setdefault(a, set()).add(b)
+            self.neighbors.setdefault(b, set()).add(a)
+            self._merge(a, b)
+
+    def _merge(self, a, b):
+        """Merge the groups of a and b, moving the smaller group into the larger one."""
+        group_a, group_b = self.group_id.get(a), self.group_id.get(b)
+        if group_a is not None and group_a == group_b:
+            return
+        members_a = self.groups_by_id[group_a] if group_a is not None else {a}
+        members_b = self.groups_by_id[group_b] if group_b is not None else {b}
+        if len(members_a) < len(members_b):
+            a, group_a, members_a, group_b, members_b = b, group_b, members_b, group_a, members_a
+
+        if group_a is None:
+            # a was on its own: it starts a new group keyed by its id
+            group_a = a
+            self.groups_by_id[a] = members_a
+            self.group_id[a] = a
+        if group_b is not None:
+            del self.groups_by_id[group_b]
+        members_a |= members_b
+        for member in members_b:
+            self.group_id[member] = group_a
+
+    def remove(self, ids):
+        """Remove images by id and re-split only the groups they belonged to."""
+        affected = set()
+        for image_id in ids:
+            if not self.alive[image_id]:
+                continue
+            self._alive_buf[image_id] = False
+            if self._name_to_id is not None:
+                del self._name_to_id[self.names[image_id]]
+            for other in self.neighbors.pop(image_id, ()):
+                self.neighbors[other].discard(image_id)
+            group = self.group_id.pop(image_id, None)
+            if group is not None:
+                affected.add(group)
+
+        for group in affected:
+            members = self.groups_by_id.pop(group) - set(ids)
+            for member in members:
+                self.group_id.pop(member, None)
+            # connected components of the remaining members, walking surviving edges
+            while members:
+                seed = members.pop()
+                component, stack = {seed}, [seed]
+                while stack:
+                    for other in self.neighbors.get(stack.pop(), ()):
+                        if other not in component:
+                            component.add(other)
+                            stack.append(other)
+                members -= component
+                if len(component) > 1:
+                    self.groups_by_id[seed] = component
+                    for member in component:
+                        self.group_id[member] = seed
+
+    def groups(self):
+        """Current duplicate groups as lists of image names."""
+        return [[self.names[member] for member in sorted(members)]
+                for members in self.groups_by_id.values() if len(members) > 1]
+
+    def _edges(self):
+        edge_i = [a for a, others in self.neighbors.items() for b in others if a < b]
+        edge_j = [b for a, others in self.neighbors.items() for b in others if a < b]
+        return np.array(edge_i, dtype=np.int64), np.array(edge_j, dtype=np.int64)
+
+    def save(self, path):
+        """Save the index to a single .npz file."""
+        edge_i, edge_j = self._edges()
+        with open(path, 'wb') as f:
+            # names as a UTF-8 blob plus offsets, like HashStore: a str array pads every name to the longest
+            name_blob, name_offsets = encode_names(self.names)
+            np.savez(
+                f,
+                config=np.array(json.dumps(self.config())),
+                name_blob=np.frombuffer(name_blob, dtype=np.uint8),
+                name_offsets=np.concatenate(([0], name_offsets)),
+                hashes=self.hashes,
+                alive=self.alive,
+                edge_i=edge_i,
+                edge_j=edge_j,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save()."""
+        with np.load(path) as data:
+            index = cls(**json.loads(str(data['config'])))
+            if 'name_blob' in data.files:
+                names = decode_names(data['name_blob'], data['name_offsets'])
+            else:
+                names = data['names'].tolist()  # written before names were stored as a blob
+            hashes = data['hashes']
+            alive = data['alive']
+            edge_i, edge_j = data['edge_i'], data['edge_j']
+
+        index.names = names
+        index._hash_buf = hashes.copy()
+        index._alive_buf = alive.copy()
+        index._name_to_id = {name: idx for idx, name in enumerate(names) if alive[idx]}
+        if names:
+            index._segments = [[0, len(names), index._build(0, len(names))]]
+        index._add_edges(edge_i, edge_j)
+        return index
+
+    def save_store(self, path):
+        """
+        Save the live images as a memory-mapped HashStore directory, with the index
+        config in its metadata and the duplicate edges in edges.npy next to it.
+        Removed images are dropped, so ids are renumbered.
+        """
+        live = np.flatnonzero(self.alive)
+        new_id = np.full(len(self.names), -1, dtype=np.int64)
+        new_id[live] = np.arange(len(live))
+        HashStore.write(path, [self.names[idx] for idx in live], self.hashes[live], metadata={'index': self.config()},
+                        hash_bits=self.hash_bits)
+        edge_i, edge_j = self._edges()
+        np.save(Path(path) / 'edges.npy', np.stack([new_id[edge_i], new_id[edge_j]]))
+
+    @classmethod
+    def open_store(cls, path):
+        """
+        Open an index saved by save_store() without copying its hashes: they stay
+        memory-mapped until the first add() moves them into a growable buffer. Names
+        are decoded from the store as they are used; the name -> id lookup is only
+        built when add() needs it.
+        """
+        store = HashStore(path)
+        index = cls(**store.metadata['index'])
+        index.names = _StoreNames(store)
+        index._hash_buf = store.hashes
+        index._alive_buf = np.ones(len(store), dtype=bool)
+        index._name_to_id = None
+        if len(store):
+            index._segments = [[0, len(store), index._build(0, len(store))]]
+        edges_path = Path(path) / 'edges.npy'
+        if edges_path.exists():
+            edge_i, edge_j = np.load(edges_path)
+            index._add_edges(edge_i, edge_j)
+        elif len(store):
+            q, item, _ = index._query(index._segments[0][2], index.hashes, self_join=True)
+            index._add_edges(q, item)
+        return index
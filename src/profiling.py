@@ -0,0 +1,136 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+_DONE = object()
+
+
+class StageTimer:
+    """
+    Accumulates wall time per pipeline stage and tells hooks when stages start and end.
+
+    A hook is any object with some of these methods, all optional:
+        stage_start(stage)              before a stage runs (may happen many times per stage)
+        stage_end(stage, seconds)       after it, with the time spent in that run
+        metrics(stats)                  once, with the final stats dict
+    """
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.times = {}
+
+    def _notify(self, method, *args):
+        for hook in self.hooks:
+            callback = getattr(hook, method, None)
+            if callback is not None:
+                callback(*args)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one run of stage name."""
+        self._notify('stage_start', name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self._notify('stage_end', name, seconds)
+
+    def timed(self, iterable, name):
+        """Iterate over iterable, timing every next() call as a run of stage name."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+    def add(self, name, seconds):
+        """Record time measured elsewhere (e.g. summed over worker processes)."""
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def report(self, stats):
+        self._notify('metrics', stats)
+
+
+def latency_summary(seconds):
+    """Percentiles of per-item latencies, in milliseconds."""
+    if not len(seconds):
+        return {}
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+    return {
+        'p50_ms': round(float(p50), 3),
+        'p90_ms': round(float(p90), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(np.max(seconds)) * 1000, 3),
+        'mean_ms': round(float(np.mean(seconds)) * 1000, 3),
+    }
+
+
+class ProfileHook:
+    """Run cProfile during the given stages (all stages if None)."""
+
+    def __init__(self, stages=None):
+        self.stages = set(stages) if stages is not None else None
+        self.profiler = cProfile.Profile()
+        self._depth = 0
+        self._ran = False
+
+    def _wanted(self, stage):
+        return self.stages is None or stage in self.stages
+
+    def stage_start(self, stage):
+        if self._wanted(stage):
+            if not self._depth:
+                self.profiler.enable()
+                self._ran = True
+            self._depth += 1
+
+    def stage_end(self, stage, seconds):
+        if self._wanted(stage):
+            self._depth -= 1
+            if not self._depth:
+                self.profiler.disable()
+
+    def summary(self, limit=20, sort='cumulative'):
+        """Top functions of the profile as text (empty if none of its stages ran in this process)."""
+        if not self._ran:
+            return ''
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class TracemallocHook:
+    """Peak traced memory (MB) per stage; tracing runs from the first wanted stage until metrics()."""
+
+    def __init__(self, stages=None):
+        self.stages = set(stages) if stages is not None else None
+        self.peak_mb = {}
+        self._started = False
+
+    def stage_start(self, stage):
+        if self.stages is not None and stage not in self.stages:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        tracemalloc.reset_peak()
+
+    def stage_end(self, stage, seconds):
+        if not tracemalloc.is_tracing() or (self.stages is not None and stage not in self.stages):
+            return
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        self.peak_mb[stage] = round(max(self.peak_mb.get(stage, 0.0), peak), 2)
+
+    def metrics(self, stats):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
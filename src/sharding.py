@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.hash_store import HashStore
+from src.utils import (LSH, MultiIndexHash, component_groups, connected_components, even_band_widths, hamming_distance,
+                       hash_bits_of, threshold_to_max_distance, tune_lsh)
+
+# result keys that differ between the shards of one run; everything else must match
+_PER_SHARD_KEYS = ('shard', 'candidates', 'edges')
+
+
+def detect_shard(hashes, max_distance, shard, num_shards, sim_method='lsh', band_widths=None, multiprobe=False,
+                 num_substrings=None):
+    """
+    Candidate generation and verification for one shard of a split run.
+    A shard indexes and probes only the LSH / multi-index buckets it owns (see
+    bucket_shard), so its tables and candidates are about 1/num_shards of a full run.
+    Shards can run in separate processes or on separate machines over the same hash
+    array; merge_shards combines their edges into the full result.
+
+    Args:
+        hashes: (N,) or (N, W) packed hashes, the same array in the same order for every shard
+        shard: This shard's id, 0 <= shard < num_shards
+        band_widths: LSH layout, required with sim_method='lsh'
+        num_substrings: Multi-index substring count for sim_method='exact' (picked from N if not given)
+    Returns:
+        dict with the run's config, the shard id, the number of candidates verified and
+        the (i, j, distance) edges found; see save_shard
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard {shard} out of range for {num_shards} shards")
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    result = {
+        'n': len(hashes),
+        'hash_bits': hash_bits_of(hashes),
+        'max_distance': int(max_distance),
+        'sim_method': sim_method,
+        'num_shards': num_shards,
+    }
+
+    if sim_method == 'lsh':
+        if band_widths is None:
+            raise ValueError("Sharded LSH needs band_widths")
+        lsh = LSH(band_widths=band_widths, multiprobe=multiprobe, hash_bits=result['hash_bits'])
+        cand_i, cand_j = lsh.index(hashes, shard=(shard, num_shards)).candidate_pairs()
+        dist = hamming_distance(hashes[cand_i], hashes[cand_j])
+        keep = dist <= max_distance
+        edges = (cand_i[keep], cand_j[keep], dist[keep])
+        candidates = len(cand_i)
+        result.update(band_widths=list(lsh.band_widths), multiprobe=bool(multiprobe))
+    elif sim_method == 'exact':
+        mih = MultiIndexHash(max_distance, num_substrings=num_substrings).build(hashes, shard=(shard, num_shards))
+        edges = mih.pairs()
+        candidates = mih.candidates_checked
+        result['num_substrings'] = mih.num_substrings
+    else:
+        raise ValueError(f"Invalid sim_method: {sim_method}. Use 'lsh' or 'exact'")
+
+    result.update(shard=shard, candidates=int(candidates), edges=edges)
+    return result
+
+
+def save_shard(result, path):
+    """Save a shard result to a single .npz file (edges as arrays, config as JSON)."""
+    config = {key: value for key, value in result.items() if key != 'edges'}
+    edge_i, edge_j, dist = result['edges']
+    with open(path, 'wb') as f:
+        np.savez(f, config=np.array(json.dumps(config)), edge_i=edge_i, edge_j=edge_j, dist=dist)
+
+
+def load_shard(path):
+    """Load a shard result written by save_shard()."""
+    with np.load(path) as data:
+        result = json.loads(str(data['config']))
+        result['edges'] = (data['edge_i'], data['edge_j'], data['dist'])
+    return result
+
+
+def merge_shards(results):
+    """
+    Combine the results of every shard of a run into one edge list.
+    results may mix shard dicts and paths of saved shards.
+    Raises ValueError if they come from different runs or a shard is missing or repeated.
+
+    Returns:
+        ((i, j, distance), stats): every edge once, sorted by (i, j), and the
+        shard count, candidates verified over all shards and edge count
+    """
+    results = [load_shard(result) if isinstance(result, (str, os.PathLike)) else result for result in results]
+    if not results:
+        raise ValueError("No shard results to merge")
+
+    config = {key: value for key, value in results[0].items() if key not in _PER_SHARD_KEYS}
+    for result in results[1:]:
+        other = {key: value for key, value in result.items() if key not in _PER_SHARD_KEYS}
+        if other != config:
+            raise ValueError(f"Shard {result['shard']} comes from a different run: {other} != {config}")
+    shard_ids = sorted(result['shard'] for result in results)
+    if shard_ids != list(range(config['num_shards'])):
+        raise ValueError(f"Expected shards 0..{config['num_shards'] - 1} once each, got {shard_ids}")
+
+    n = config['n']
+    edge_i, edge_j, dist = (np.concatenate(column) for column in zip(*(result['edges'] for result in results)))
+    edge_i, edge_j = edge_i.astype(np.int64), edge_j.astype(np.int64)
+    # a pair sharing buckets in several bands can be found by several shards: keep it once
+    codes = edge_i * n + edge_j
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    if len(codes):
+        order = order[np.concatenate(([True], codes[1:] != codes[:-1]))]
+    stats = {
+        'shards': config['num_shards'],
+        'candidates': sum(result['candidates'] for result in results),
+        'edges': len(order),
+    }
+    return (edge_i[order], edge_j[order], dist[order]), stats
+
+
+_worker_hashes = None
+
+
+def _init_worker(hashes):
+    global _worker_hashes
+    _worker_hashes = hashes.hashes if isinstance(hashes, HashStore) else hashes
+
+
+def _detect_in_worker(shard, **shard_params):
+    return detect_shard(_worker_hashes, shard=shard, **shard_params)
+
+
+def run_shards(hashes, max_distance, num_shards, workers=None, **shard_params):
+    """
+    Run every shard of a split detection in a process pool and merge them.
+    Each worker process receives the hash array once and works through its shards one
+    at a time, so only that shard's tables and candidates are held at any moment.
+    hashes may be a HashStore: workers then map its file instead of receiving a copy,
+    and all of them share one copy of the hashes through the page cache.
+    shard_params: sim_method, band_widths, multiprobe, num_substrings (see detect_shard)
+    Returns: merge_shards output
+    """
+    workers = min(workers or os.cpu_count() or 1, num_shards)
+    params = dict(shard_params, max_distance=max_distance, num_shards=num_shards)
+    if workers == 1:
+        if isinstance(hashes, HashStore):
+            hashes = hashes.hashes
+        results = [detect_shard(hashes, shard=shard, **params) for shard in range(num_shards)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(hashes,)) as executor:
+            results = list(executor.map(partial(_detect_in_worker, **params), range(num_shards)))
+    return merge_shards(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split duplicate detection over shards, e.g. one per machine, then merge the results.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    detect = commands.add_parser('detect', help="Find the edges of one shard")
+    detect.add_argument("hashes", help=".npy file or HashStore directory of packed hashes (memory-mapped, "
+                                       "the same one for every shard)")
+    detect.add_argument("--shard", type=int, required=True)
+    detect.add_argument("--num-shards", type=int, required=True)
+    detect.add_argument("--threshold", type=float, default=85)
+    detect.add_argument("--method", choices=['lsh', 'exact'], default='lsh')
+    detect.add_argument("--bands", type=int, default=None,
+                        help="LSH bands (default: tuned on a fixed sample, so every shard gets the same layout)")
+    detect.add_argument("--target-recall", type=float, default=0.95)
+    detect.add_argument("--multiprobe", action='store_true')
+    detect.add_argument("--output", required=True, help="Shard result (.npz) to write")
+
+    merge = commands.add_parser('merge', help="Merge shard results and group them")
+    merge.add_argument("shards", nargs='+', help="Shard result files, one per shard")
+    merge.add_argument("--output", required=True, help="Merged edges and group labels (.npz) to write")
+    args = parser.parse_args()
+
+    if args.command == 'detect':
+        hashes = HashStore(args.hashes).hashes if os.path.isdir(args.hashes) else np.load(args.hashes, mmap_mode='r')
+        hash_bits = hash_bits_of(hashes)
+        max_distance = threshold_to_max_distance(args.threshold, hash_bits)
+        params = {'sim_method': args.method}
+        if args.method == 'lsh':
+            if args.bands:
+                params.update(band_widths=even_band_widths(args.bands, hash_bits), multiprobe=args.multiprobe)
+            else:
+                from src.Feature_Extractions import LSH_TUNING_SAMPLE
+                sample_ids = np.sort(np.random.default_rng(0).choice(len(hashes), min(len(hashes), LSH_TUNING_SAMPLE),
+                                                                     replace=False))
+                layout = tune_lsh(max_distance, args.target_recall, n=len(hashes), sample=hashes[sample_ids],
+                                  multiprobe=args.multiprobe, hash_bits=hash_bits)
+                params.update(band_widths=layout['band_widths'], multiprobe=layout['multiprobe'])
+        result = detect_shard(hashes, max_distance, args.shard, args.num_shards, **params)
+        save_shard(result, args.output)
+        print(f"Shard {args.shard}/{args.num_shards}: {result['candidates']} candidates, "
+              f"{len(result['edges'][0])} edges -> {args.output}")
+    else:
+        (edge_i, edge_j, dist), stats = merge_shards(args.shards)
+        n = load_shard(args.shards[0])['n']
+        labels = connected_components(n, edge_i, edge_j)
+        with open(args.output, 'wb') as f:
+            np.savez(f, edge_i=edge_i, edge_j=edge_j, dist=dist, labels=labels)
+        print(f"Merged {stats['shards']} shards: {stats['edges']} edges, "
+              f"{len(component_groups(labels))} duplicate groups -> {args.output}")
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.Feature_Extractions import hash_images, iter_image_files
+from src.utils import (LSH, MultiIndexHash, UnionFind, bruteforce_pairs, connected_components, hamming_distance,
+                       threshold_to_max_distance, HASH_BITS, WORD_BITS)
+
+
+def synthetic_hashes(n, duplicate_fraction=0.2, max_flips=4, seed=0, hash_bits=HASH_BITS):
+    """
+    Random packed hashes where duplicate_fraction of them are near-copies
+    (up to max_flips bits flipped, scaled with the hash size) of another hash in the set.
+    Returns: (n,) uint64 array, or (n, hash_bits // 64) words for wider hashes
+    """
+    rng = np.random.default_rng(seed)
+    num_words = hash_bits // WORD_BITS
+    max_flips = max_flips * num_words
+    hashes = rng.integers(0, 2**64, size=(n, num_words), dtype=np.uint64)
+    n_dups = int(n * duplicate_fraction)
+    if n_dups:
+        targets = rng.choice(n, n_dups, replace=False)
+        sources = rng.integers(0, n, n_dups)
+        bits = rng.integers(0, hash_bits, (n_dups, max_flips))
+        used = np.arange(max_flips) < rng.integers(0, max_flips + 1, n_dups)[:, None]
+        masks = np.zeros((n_dups, num_words), dtype=np.uint64)
+        for word in range(num_words):
+            in_word = used & (bits // WORD_BITS == word)
+            shifts = (WORD_BITS - 1 - bits % WORD_BITS).astype(np.uint64)
+            masks[:, word] = np.bitwise_xor.reduce(np.where(in_word, np.uint64(1) << shifts, np.uint64(0)), axis=1)
+        hashes[targets] = hashes[sources] ^ masks
+    return hashes[:, 0] if num_words == 1 else hashes
+
+
+def synthetic_images(n, folder, size=256, seed=0):
+    """Write n smooth random JPEGs of size × size pixels into folder. Returns: list of paths."""
+    rng = np.random.default_rng(seed)
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for idx in range(n):
+        low_res = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8))
+        path = folder / f"synthetic_{idx:07d}.jpg"
+        low_res.resize((size, size), Image.BICUBIC).save(path, quality=90)
+        paths.append(str(path))
+    return paths
+
+
+def measure(stage, n, fn, memory=True):
+    """
+    Time fn() once, then run it again under tracemalloc for its peak allocation
+    (NumPy buffers included; worker processes are not traced).
+    Returns: (fn's result, result record)
+    """
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+
+    return result, {
+        'stage': stage,
+        'n': n,
+        'seconds': round(seconds, 4),
+        'per_second': round(n / seconds, 1) if seconds > 0 else None,
+        'peak_mb': peak_mb,
+    }
+
+
+def _pair_codes(n, i, j):
+    """Sorted i * n + j codes of pairs with i < j, for set comparisons."""
+    return np.sort(np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j))
+
+
+def _sampled_truth(hashes, sample, max_distance):
+    """(query, item) pairs within max_distance for the sampled ids, brute-forced one query at a time."""
+    queries, items = [], []
+    for query in sample.tolist():
+        item = np.flatnonzero(hamming_distance(hashes, hashes[query]) <= max_distance)
+        item = item[item != query]
+        queries.append(np.full(len(item), query, dtype=np.int64))
+        items.append(item)
+    return np.concatenate(queries), np.concatenate(items)
+
+
+def benchmark_hashes(n, threshold=85, num_bands=4, rows_per_band=16, multiprobe=False, exact_max=250_000,
+                     bruteforce_max=200_000, max_candidates=500_000_000, recall_sample=1000, memory=True, seed=0,
+                     hash_bits=HASH_BITS):
+    """
+    Benchmark candidate generation, comparison and grouping on n synthetic hash_bits-bit hashes.
+    The exact index is the recall ground truth up to exact_max hashes; above that LSH recall
+    is estimated on recall_sample random queries brute-forced against the whole set.
+    Bruteforce is skipped above bruteforce_max hashes, and LSH when the expected number
+    of random bucket collisions exceeds max_candidates.
+    Returns: list of result records, one per stage
+    """
+    hashes = synthetic_hashes(n, seed=seed, hash_bits=hash_bits)
+    max_distance = threshold_to_max_distance(threshold, hash_bits)
+    results = []
+    truth = edges = None
+
+    if n <= exact_max:
+        (truth_i, truth_j, _), record = measure(
+            'exact', n, lambda: MultiIndexHash(max_distance).build(hashes).pairs(), memory)
+        record['pairs'] = len(truth_i)
+        results.append(record)
+        truth = _pair_codes(n, truth_i, truth_j)
+        edges = (truth_i, truth_j)
+    else:
+        results.append({'stage': 'exact', 'n': n, 'skipped': f"more than {exact_max} hashes"})
+
+    if n <= bruteforce_max:
+        (brute_i, brute_j, _), record = measure('bruteforce', n, lambda: bruteforce_pairs(hashes, max_distance), memory)
+        record['pairs'] = len(brute_i)
+        if truth is not None:
+            record['matches_exact'] = bool(np.array_equal(_pair_codes(n, brute_i, brute_j), truth))
+        results.append(record)
+    else:
+        results.append({'stage': 'bruteforce', 'n': n, 'skipped': f"more than {bruteforce_max} hashes"})
+
+    # random hashes collide in a band with probability 2^-rows
+    expected = num_bands * n * (n - 1) / 2 * 2.0 ** -rows_per_band * (rows_per_band + 1 if multiprobe else 1)
+    layout = {'num_bands': num_bands, 'rows_per_band': rows_per_band, 'multiprobe': multiprobe, 'hash_bits': hash_bits}
+    if expected <= max_candidates:
+        lsh = LSH(num_bands, rows_per_band, multiprobe=multiprobe, hash_bits=hash_bits)
+        _, record = measure('lsh_index', n, lambda: lsh.index(hashes), memory)
+        results.append({**record, **layout})
+
+        def lsh_pairs():
+            cand_i, cand_j = lsh.candidate_pairs()
+            keep = hamming_distance(hashes[cand_i], hashes[cand_j]) <= max_distance
+            return cand_i, cand_j, keep
+        (cand_i, cand_j, keep), record = measure('lsh_candidates', n, lsh_pairs, memory)
+        found_i, found_j = cand_i[keep], cand_j[keep]
+        record.update(layout, candidates=len(cand_i), pairs=len(found_i))
+        if truth is not None:
+            recovered = np.isin(truth, _pair_codes(n, found_i, found_j))
+            record['recall'] = round(float(recovered.mean()), 4) if len(truth) else 1.0
+        else:
+            sample = np.random.default_rng(seed).choice(n, min(n, recall_sample), replace=False)
+            sample_q, sample_item = _sampled_truth(hashes, sample, max_distance)
+            # found pairs seen from either end, as query * n + item codes
+            found = np.concatenate([found_i * n + found_j, found_j * n + found_i])
+            sampled = np.isin(sample_q * n + sample_item, found)
+            record['recall_sampled'] = round(float(sampled.mean()), 4) if len(sampled) else 1.0
+            record['recall_sample_pairs'] = len(sampled)
+        results.append(record)
+        if edges is None:
+            edges = (found_i, found_j)
+
+        queries = hashes[:min(n, 1000)]
+        _, record = measure('lsh_query', len(queries), lambda: lsh.get_candidates(queries), memory)
+        results.append({**record, **layout})
+    else:
+        results.append({'stage': 'lsh_candidates', 'n': n, **layout,
+                        'skipped': f"about {expected:.3g} random candidates expected"})
+
+    if edges is None:
+        return results
+    edge_i, edge_j = edges
+
+    def union_find():
+        unionf = UnionFind(n)
+        for i, j in zip(edge_i.tolist(), edge_j.tolist()):
+            unionf.union(i, j)
+        return unionf
+    _, record = measure('union_find', len(edge_i), union_find, memory)
+    results.append({**record, 'images': n})
+    _, record = measure('connected_components', len(edge_i),
+                        lambda: connected_components(n, edge_i, edge_j), memory)
+    results.append({**record, 'images': n})
+
+    # one hub holding the highest id, its edges sorted by (i, j) like the exact and lsh edge lists
+    hub_i, hub_j = np.arange(n - 1), np.full(n - 1, n - 1)
+    _, record = measure('components_hub', len(hub_i), lambda: connected_components(n, hub_i, hub_j), memory)
+    results.append({**record, 'images': n})
+    return results
+
+
+def benchmark_images(paths, workers=None, fast_decode=False, memory=True, io_threads=None):
+    """Benchmark decode + perceptual hash over image files (io_threads: prefetch reads, see iter_hash_images)."""
+    params = {'hash_size': 32, 'fast_decode': True} if fast_decode else {'hash_size': 32}
+    _, record = measure('decode_hash', len(paths),
+                        lambda: hash_images(paths, 'phash', workers=workers, io_threads=io_threads, **params), memory)
+    record.update(workers=workers or os.cpu_count(), fast_decode=fast_decode, io_threads=io_threads)
+    return [record]
+
+
+def environment():
+    """Machine and library versions stored next to the results."""
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hashing, candidate generation and grouping.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000],
+                        help="Synthetic hash set sizes")
+    parser.add_argument("--image-sizes", type=int, nargs='*', default=[1_000],
+                        help="Synthetic image set sizes for the decode + hash stage")
+    parser.add_argument("--image-dir", help="Benchmark decode + hash on the images of this folder instead")
+    parser.add_argument("--threshold", type=float, default=85)
+    parser.add_argument("--bands", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=None, help="Rows per band (default: hash bits / bands)")
+    parser.add_argument("--hash-bits", type=int, default=HASH_BITS, help="Synthetic hash size, a multiple of 64")
+    parser.add_argument("--multiprobe", action='store_true')
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes (default: all cores)")
+    parser.add_argument("--fast-decode", action='store_true')
+    parser.add_argument("--io-threads", type=int, default=None,
+                        help="Read image files ahead with this many threads (for network storage)")
+    parser.add_argument("--exact-max", type=int, default=250_000,
+                        help="Above this many hashes, skip the exact index and sample LSH recall instead")
+    parser.add_argument("--recall-sample", type=int, default=1000,
+                        help="Queries brute-forced for the sampled recall estimate")
+    parser.add_argument("--bruteforce-max", type=int, default=200_000,
+                        help="Skip Bruteforce above this many hashes")
+    parser.add_argument("--max-candidates", type=float, default=5e8,
+                        help="Skip LSH when more random candidates than this are expected")
+    parser.add_argument("--no-memory", action='store_true', help="Skip the tracemalloc peak memory runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write")
+    args = parser.parse_args()
+    memory = not args.no_memory
+    rows = args.rows or args.hash_bits // args.bands
+
+    results = []
+    for n in args.sizes:
+        print(f"Hashes: {n}")
+        results.extend(benchmark_hashes(n, args.threshold, args.bands, rows, args.multiprobe, args.exact_max,
+                                        args.bruteforce_max, args.max_candidates, args.recall_sample, memory,
+                                        args.seed, args.hash_bits))
+
+    if args.image_dir:
+        paths = [f.path for f in iter_image_files(args.image_dir)]
+        print(f"Images: {len(paths)} from {args.image_dir}")
+        results.extend(benchmark_images(paths, args.workers, args.fast_decode, memory, args.io_threads))
+    else:
+        for n in args.image_sizes:
+            print(f"Images: {n}")
+            with tempfile.TemporaryDirectory() as temp_dir:
+                paths = synthetic_images(n, temp_dir, seed=args.seed)
+                results.extend(benchmark_images(paths, args.workers, args.fast_decode, memory, args.io_threads))
+
+    report = {'environment': environment(), 'config': vars(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("\n" + "="*72)
+    print(f"{'stage':<22}{'n':>10}{'seconds':>10}{'per second':>14}{'peak MB':>10}  notes")
+    print("="*72)
+    for record in results:
+        if 'skipped' in record:
+            print(f"{record['stage']:<22}{record['n']:>10}  skipped: {record['skipped']}")
+            continue
+        notes = ', '.join(f"{key}={record[key]}" for key in ('pairs', 'candidates', 'recall', 'recall_sampled',
+                                                             'matches_exact')
+                          if key in record)
+        print(f"{record['stage']:<22}{record['n']:>10}{record['seconds']:>10}{record['per_second'] or '-':>14}"
+              f"{record['peak_mb'] if record['peak_mb'] is not None else '-':>10}  {notes}")
+    print("="*72)
+    print(f"Results written to {args.output}\n")
@@ -0,0 +1,74 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.Feature_Extractions import _load_pixels, perceptual_hash_batch
+from src.utils import hamming_distance, HASH_BITS
+
+
+def measure_fast_decode_drift(image_paths, hash_size=32):
+    """
+    Hash every image with the full decode path and with fast_decode,
+    and measure how far the fast hashes drift from the reference ones.
+    Returns: dict with per-file distances, drift summary and timings
+    """
+    image_paths = [str(path) for path in image_paths]
+    timings = {}
+    hashes = {}
+    for fast in (False, True):
+        start = time.perf_counter()
+        pixels = np.stack([_load_pixels(path, hash_size, fast_decode=fast) for path in image_paths])
+        hashes[fast] = perceptual_hash_batch(pixels)
+        timings[fast] = time.perf_counter() - start
+
+    distances = hamming_distance(hashes[False], hashes[True]).astype(int)
+    return {
+        'files': len(image_paths),
+        'distances': dict(zip(image_paths, distances.tolist())),
+        'identical_pct': round(100 * float(np.mean(distances == 0)), 2),
+        'mean_distance': round(float(distances.mean()), 3),
+        'p99_distance': int(np.percentile(distances, 99)),
+        'max_distance': int(distances.max()),
+        'full_decode_time': round(timings[False], 4),
+        'fast_decode_time': round(timings[True], 4),
+        'speedup': round(timings[False] / timings[True], 2) if timings[True] > 0 else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure hash drift of the fast JPEG decode path.")
+    parser.add_argument("folder", help="Folder with sample images (searched recursively)")
+    parser.add_argument("--max-drift", type=int, default=2,
+                        help="Exit non-zero if any file drifts by more than this many bits")
+    args = parser.parse_args()
+
+    image_extensions = {'.jpg', '.jpeg', '.png'}
+    images = sorted(f for f in Path(args.folder).rglob('*') if f.suffix.lower() in image_extensions)
+    if not images:
+        sys.exit(f"No images found in {args.folder}")
+
+    report = measure_fast_decode_drift(images)
+
+    print("\n" + "="*60)
+    print(f"Fast decode drift over {report['files']} images ({HASH_BITS}-bit hashes)")
+    print("="*60)
+    print(f"Identical hashes:  {report['identical_pct']}%")
+    print(f"Mean drift:        {report['mean_distance']} bits")
+    print(f"p99 / max drift:   {report['p99_distance']} / {report['max_distance']} bits")
+    print(f"Full decode:       {report['full_decode_time']}s")
+    print(f"Fast decode:       {report['fast_decode_time']}s ({report['speedup']}x)")
+
+    worst = sorted(report['distances'].items(), key=lambda item: item[1], reverse=True)[:5]
+    for path, distance in worst:
+        if distance > 0:
+            print(f"  {distance:2d} bits  {path}")
+    print("="*60 + "\n")
+
+    if report['max_distance'] > args.max_drift:
+        sys.exit(1)
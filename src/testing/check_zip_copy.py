@@ -0,0 +1,101 @@
+import argparse
+import io
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+import src.Feature_Extractions as feature_extractions
+from src.Feature_Extractions import copy_zip_members
+
+
+class _Unseekable(io.RawIOBase):
+    """Write-only stream without seek/tell, so zipfile writes data descriptors (flag bit 3)."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def build_source_zips(members):
+    """
+    Source archives holding members (name -> bytes): one written to a seekable file,
+    one streamed to an unseekable one so every member carries a data descriptor.
+    Returns: {label: zip bytes}
+    """
+    archives = {}
+    for label, seekable in (('seekable', True), ('data descriptors', False)):
+        out = io.BytesIO() if seekable else _Unseekable()
+        with zipfile.ZipFile(out, 'w') as zip_file:
+            for idx, (name, data) in enumerate(members.items()):
+                info = zipfile.ZipInfo(name)
+                info.compress_type = zipfile.ZIP_STORED if idx % 2 else zipfile.ZIP_DEFLATED
+                with zip_file.open(info, 'w') as member:
+                    member.write(data)
+        archives[label] = out.getvalue() if seekable else out.buffer.getvalue()
+    return archives
+
+
+def check_round_trip(source_bytes, names, raw_copy=True):
+    """
+    Copy names out of a source archive with copy_zip_members and read the result back.
+    Returns: list of problems found (empty if the copy is a valid archive with the same contents)
+    """
+    problems = []
+    saved = feature_extractions._ZIP_RAW_COPY
+    feature_extractions._ZIP_RAW_COPY = saved and raw_copy
+    try:
+        with zipfile.ZipFile(io.BytesIO(source_bytes)) as source_zip, tempfile.TemporaryFile() as out_file:
+            copy_zip_members(source_zip, names, out_file)
+            out_file.seek(0)
+            with zipfile.ZipFile(out_file) as out_zip:
+                bad = out_zip.testzip()
+                if bad is not None:
+                    problems.append(f"bad CRC for {bad}")
+                if out_zip.namelist() != list(names):
+                    problems.append(f"members {out_zip.namelist()}, expected {list(names)}")
+                for name in names:
+                    if name in out_zip.NameToInfo and out_zip.read(name) != source_zip.read(name):
+                        problems.append(f"contents differ for {name}")
+                    if name in out_zip.NameToInfo and out_zip.getinfo(name).flag_bits & 0x08:
+                        problems.append(f"data descriptor left on {name}")
+    finally:
+        feature_extractions._ZIP_RAW_COPY = saved
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Round-trip check of copy_zip_members.")
+    parser.add_argument("folder", nargs='?', help="Folder with sample files to archive (default: generated data)")
+    args = parser.parse_args()
+
+    if args.folder:
+        members = {path.name: path.read_bytes() for path in sorted(Path(args.folder).iterdir()) if path.is_file()}
+    else:
+        members = {f"img_{idx}.jpg": bytes(range(256)) * (idx + 1) * 64 for idx in range(6)}
+    if not members:
+        sys.exit(f"No files found in {args.folder}")
+    kept = list(members)[::2]
+
+    print(f"\nRaw-copy internals available: {feature_extractions._ZIP_RAW_COPY}")
+    failed = False
+    for label, source_bytes in build_source_zips(members).items():
+        for raw_copy in (True, False):
+            problems = check_round_trip(source_bytes, kept, raw_copy=raw_copy)
+            mode = 'raw copy' if raw_copy else 'fallback'
+            print(f"{label:18s} {mode:9s} {'OK' if not problems else 'FAILED'}")
+            for problem in problems:
+                print(f"  {problem}")
+            failed = failed or bool(problems)
+    print()
+
+    if failed:
+        sys.exit(1)
@@ -1,74 +1,518 @@
-from collections import defaultdict
+from functools import lru_cache
+from itertools import combinations
+from math import comb
+
+import numpy as np
+
+
+HASH_BITS = 64
+
+# hashes are packed MSB first into 64-bit words: (N,) uint64 for 64-bit hashes,
+# (N, W) uint64 with word 0 holding the first bits for wider ones
+WORD_BITS = 64
 
 
 class UnionFind:
-    """ Union-Find data structure for grouping duplicates."""
+    """
+    Union-Find over integer ids 0..n-1 for grouping duplicates.
+    Parents and sizes live in flat lists, which are faster than NumPy arrays
+    for one element at a time; see connected_components for bulk edge lists.
+    """
     
-    def __init__(self, elements):
-        self.parent = {element: element for element in elements}
-        self.rank = {element: 0 for element in elements}
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
     
     def find(self, element):
         """
-        Find root of element with path compression.
-        Path compression flattens the tree for faster future lookups.
+        Find root of element with path halving.
+        Every visited node is pointed at its grandparent, iteratively, so long
+        chains flatten without recursion.
         """
-        if self.parent[element] != element:
-            # Recursively find root and compress path
-            self.parent[element] = self.find(self.parent[element])
-        return self.parent[element]
+        parent = self.parent
+        while parent[element] != element:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
+        return element
     
     def union(self, element1, element2):
         """
-        Union two sets by rank
+        Union two sets by size
+        Returns the root of the merged set.
         """
         root1 = self.find(element1)
         root2 = self.find(element2)
         
         if root1 != root2:
-            if self.rank[root1] < self.rank[root2]:
-                self.parent[root1] = root2
-            elif self.rank[root1] > self.rank[root2]:
-                self.parent[root2] = root1
-            else:
-                # equal rank: attach root2 under root1 and increment rank
-                self.parent[root2] = root1
-                self.rank[root1] += 1
+            if self.size[root1] < self.size[root2]:
+                root1, root2 = root2, root1
+            self.parent[root2] = root1
+            self.size[root1] += self.size[root2]
+        return root1
+    
+    def labels(self):
+        """Root of every id, as an array."""
+        return np.array([self.find(element) for element in range(len(self.parent))], dtype=np.int64)
     
     def get_groups(self):
         """ Get groups of connected elements."""
-        groups = {}
-        for element in self.parent:
-            root = self.find(element)
-            if root not in groups:
-                groups[root] = []
-            groups[root].append(element)
-        
-        return [group for group in groups.values() if len(group) > 1]
+        return component_groups(self.labels())
+
+
+def connected_components(n, edge_i, edge_j):
+    """
+    Connected component label of every id in 0..n-1 for an undirected edge list.
+    Vectorized hooking: each round points every root at the smallest label among
+    its still split edges, then pointer-jumps all labels to their root.
+    Edges inside a finished component are dropped as soon as they agree.
+    Returns: Array of labels, each component labelled by its smallest id
+    """
+    dtype = np.int32 if n < 2**31 else np.int64
+    labels = np.arange(n, dtype=dtype)
+    edge_i = np.asarray(edge_i, dtype=dtype)
+    edge_j = np.asarray(edge_j, dtype=dtype)
+    
+    while len(edge_i):
+        label_i, label_j = labels[edge_i], labels[edge_j]
+        split = label_i != label_j
+        if not split.all():
+            edge_i, edge_j, label_i, label_j = edge_i[split], edge_j[split], label_i[split], label_j[split]
+            if not len(edge_i):
+                break
+        # minimum.at, not plain assignment: a hub's root takes its smallest neighbour at once
+        # instead of whichever edge happens to be written last
+        np.minimum.at(labels, np.maximum(label_i, label_j), np.minimum(label_i, label_j))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return labels
+
+
+def component_groups(labels):
+    """Ids of every component with more than one member, as arrays, ordered by label."""
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1
+    return [group for group in np.split(order, starts) if len(group) > 1]
+
+
+def pack_bits(bits):
+    """Pack boolean hash bits (MSB first) into uint64 hashes.
+    Accepts a single bit vector or an (N, B) matrix, B a multiple of 64.
+    64-bit hashes come back as a np.uint64 scalar or an (N,) array, wider
+    ones as a (W,) or (N, W) array of words."""
+    bits = np.asarray(bits, dtype=bool)
+    if bits.shape[-1] % WORD_BITS:
+        raise ValueError(f"Hash size must be a multiple of {WORD_BITS} bits, got {bits.shape[-1]}")
+    packed = np.packbits(bits, axis=-1).view('>u8').astype(np.uint64)
+    if packed.shape[-1] > 1:
+        return packed
+    if bits.ndim == 1:
+        return packed[0]
+    return packed[..., 0]
+
+
+def unpack_bits(hashes):
+    """Inverse of pack_bits: (N, B) uint8 matrix of hash bits, MSB first."""
+    words = hash_words(hashes)
+    return np.unpackbits(words.astype('>u8').view(np.uint8), axis=1)
+
+
+def hash_words(hashes):
+    """View packed hashes as an (N, W) word matrix, whatever their width."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    return hashes[:, None] if hashes.ndim == 1 else hashes
+
+
+def hash_bits_of(hashes):
+    """Hash size in bits of an array of packed hashes."""
+    return WORD_BITS * hash_words(hashes).shape[1]
+
+
+def hash_to_int(image_hash):
+    """A single packed hash (np.uint64 or array of words) as a Python int."""
+    value = 0
+    for word in np.atleast_1d(np.asarray(image_hash, dtype=np.uint64)).tolist():
+        value = (value << WORD_BITS) | word
+    return value
+
+
+def hash_to_string(image_hash, hash_bits=HASH_BITS):
+    """Format a packed hash as a binary string, for display only."""
+    return format(hash_to_int(image_hash), f'0{hash_bits}b')
+
+
+def string_to_hash(hash_string):
+    """Parse a binary hash string back into a packed hash (np.uint64, or words if wider)."""
+    value = int(hash_string, 2)
+    words = -(-len(hash_string) // WORD_BITS)
+    if words <= 1:
+        return np.uint64(value)
+    return np.array([(value >> (WORD_BITS * (words - 1 - idx))) & (2**WORD_BITS - 1) for idx in range(words)],
+                    dtype=np.uint64)
 
 
 def hamming_distance(hash1, hash2):
-    """Calculate Hamming distance between two hashes.
-    Returns the number of differing bits."""
+    """Calculate Hamming distance between two packed hashes.
+    Returns the number of differing bits, i.e. popcount(hash1 ^ hash2).
+    NumPy uint64 arrays are compared element-wise; arrays with two or more
+    dimensions are read as (..., W) multi-word hashes and their words added up."""
     
     if hash1 is None or hash2 is None:
         return float('inf')
-    if len(hash1) != len(hash2):
-        raise ValueError(f"Hash lengths don't match: {len(hash1)} vs {len(hash2)}")
+    if isinstance(hash1, np.ndarray) or isinstance(hash2, np.ndarray):
+        distance = np.bitwise_count(np.bitwise_xor(hash1, hash2))
+        if np.ndim(hash1) > 1 or np.ndim(hash2) > 1:
+            distance = distance.sum(axis=-1, dtype=np.uint16)
+        return distance
     
-    return sum(c1 != c2 for c1, c2 in zip(hash1, hash2))
+    return (int(hash1) ^ int(hash2)).bit_count()
 
 
-def similarity_score(hash1, hash2):
+def similarity_score(hash1, hash2, hash_bits=HASH_BITS):
     """Calculate similarity percentage between two hashes."""
     
     if hash1 is None or hash2 is None:
         return 0.0
+    if hash_bits > WORD_BITS:
+        # single multi-word hashes are (W,) rows: compare them whole
+        return distance_to_similarity((hash_to_int(hash1) ^ hash_to_int(hash2)).bit_count(), hash_bits)
     distance = hamming_distance(hash1, hash2)
     if distance == float('inf'):
         return 0.0
-    max_distance = len(hash1)
-    return ((max_distance - distance) / max_distance) * 100.0
+    return distance_to_similarity(distance, hash_bits)
+
+
+def distance_to_similarity(distance, hash_bits=HASH_BITS):
+    """Convert a Hamming distance (scalar or array) into a similarity percentage."""
+    return ((hash_bits - distance) / hash_bits) * 100.0
+
+def threshold_to_max_distance(threshold, hash_bits=HASH_BITS):
+    """Largest Hamming distance whose similarity still meets threshold (%)."""
+    return int(np.floor(hash_bits * (100.0 - threshold) / 100.0 + 1e-9))
+
+
+def iter_bruteforce_pairs(hashes, max_distance, row_block=128, col_block=8192):
+    """
+    Exact all-pairs search over packed hashes, one row block at a time.
+    XORs and popcounts row_block × col_block tiles of the hash array against
+    each other, reusing the same scratch buffers, so memory stays bounded
+    no matter how many hashes are compared. Multi-word hashes are compared
+    word by word, adding each word's popcount into the tile's distances.
+    
+    Yields:
+        (row_end, i, j, distance) after each row block: every pair i < j within
+        max_distance with i < row_end has been reported once row_end is yielded
+    """
+    words = hash_words(hashes)
+    n, num_words = words.shape
+    
+    xor_buf = np.empty((row_block, col_block), dtype=np.uint64)
+    dist_buf = np.empty((row_block, col_block), dtype=np.uint8 if num_words == 1 else np.uint16)
+    count_buf = np.empty((row_block, col_block), dtype=np.uint8)
+    mask_buf = np.empty((row_block, col_block), dtype=bool)
+    
+    for r0 in range(0, n, row_block):
+        block = words[r0:r0 + row_block]
+        rows, cols, dists = [], [], []
+        for c0 in range(r0, n, col_block):
+            other = words[c0:c0 + col_block]
+            shape = (block.shape[0], other.shape[0])
+            
+            xor = xor_buf[:shape[0], :shape[1]]
+            dist = dist_buf[:shape[0], :shape[1]]
+            count = count_buf[:shape[0], :shape[1]]
+            mask = mask_buf[:shape[0], :shape[1]]
+            for word in range(num_words):
+                np.bitwise_xor(block[:, word, None], other[None, :, word], out=xor)
+                if word == 0:
+                    np.bitwise_count(xor, out=dist)
+                else:
+                    np.bitwise_count(xor, out=count)
+                    np.add(dist, count, out=dist)
+            np.less_equal(dist, max_distance, out=mask)
+            
+            if c0 < r0 + shape[0]:
+                # tile straddles the diagonal: keep only i < j
+                mask &= np.arange(c0, c0 + shape[1]) > np.arange(r0, r0 + shape[0])[:, None]
+            
+            if mask.any():
+                i, j = np.nonzero(mask)
+                rows.append(i + r0)
+                cols.append(j + c0)
+                dists.append(dist[i, j])
+        
+        row_end = r0 + block.shape[0]
+        if rows:
+            yield row_end, np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+        else:
+            yield (row_end,) + _empty_edges()
+
+
+def bruteforce_pairs(hashes, max_distance, row_block=128, col_block=8192):
+    """
+    Exact all-pairs search over packed hashes (see iter_bruteforce_pairs).
+    
+    Args:
+        hashes: (N,) or (N, W) uint64 array of packed hashes
+        max_distance: Largest Hamming distance reported
+    Returns:
+        (i, j, distance) arrays for every pair i < j within max_distance
+    """
+    blocks = [block[1:] for block in iter_bruteforce_pairs(hashes, max_distance, row_block, col_block)]
+    if not blocks:
+        return _empty_edges()
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+
+def _unique_codes(codes):
+    """Sorted unique values of an int64 array (sort-based; faster than np.unique's hashing here)."""
+    codes = np.sort(codes)
+    if len(codes):
+        codes = codes[np.concatenate(([True], codes[1:] != codes[:-1]))]
+    return codes
+
+
+def _empty_edges():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+
+
+def _band_values(hashes, start, width, hash_bits=HASH_BITS):
+    """
+    Extract bits [start, start + width) (MSB first) of packed hashes as integers.
+    Bands of up to 64 bits may straddle two words of multi-word hashes.
+    """
+    if width > WORD_BITS or start + width > hash_bits:
+        raise ValueError(f"Cannot extract bits [{start}, {start + width}) of {hash_bits}-bit hashes as one integer")
+    words = hash_words(hashes)
+    mask = np.uint64((1 << width) - 1)
+    first, end = start // WORD_BITS, start + width
+    word_end = WORD_BITS * (first + 1)
+    if end <= word_end:
+        return (words[:, first] >> np.uint64(word_end - end)) & mask
+    # high bits from the tail of the first word, low bits from the head of the next
+    spill = end - word_end
+    return ((words[:, first] << np.uint64(spill)) | (words[:, first + 1] >> np.uint64(WORD_BITS - spill))) & mask
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(width, radius):
+    """All width-bit masks with at most radius bits set (cached and read-only)."""
+    masks = [sum(1 << bit for bit in bits)
+             for r in range(radius + 1) for bits in combinations(range(width), r)]
+    masks = np.array(masks, dtype=np.uint64)
+    masks.flags.writeable = False
+    return masks
+
+
+# external MultiIndexHash queries probe at most this many (query, mask) keys per lookup
+PROBE_BLOCK = 1 << 18
+
+# bands up to this width get a direct-address (CSR) bucket table, wider ones a sorted key array
+CSR_MAX_WIDTH = 22
+
+
+def bucket_shard(band_idx, keys, num_shards):
+    """
+    Shard owning each bucket key of a band: a multiplicative hash of (band, key), so
+    buckets spread evenly over shards whatever the key distribution.
+    """
+    mixed = (keys ^ np.uint64((band_idx * 0x9E3779B97F4A7C15) % 2**64)) * np.uint64(0xBF58476D1CE4E5B9)
+    return (mixed >> np.uint64(32)) % np.uint64(num_shards)
+
+
+def _owned(band_idx, keys, shard):
+    """Positions of the keys whose bucket belongs to shard ((shard id, num_shards), or None for all)."""
+    if shard is None:
+        return None
+    shard_id, num_shards = shard
+    return np.flatnonzero(bucket_shard(band_idx, keys, num_shards) == shard_id)
+
+
+def _build_table(band_idx, keys, width, shard):
+    """Bucket table over the items whose bucket belongs to shard (all items without one)."""
+    owned = _owned(band_idx, keys, shard)
+    if owned is None:
+        return _BucketTable(keys, width)
+    return _BucketTable(keys[owned], width, owned)
+
+
+def _match(table, band_idx, keys, shard):
+    """table.match(keys), skipping the keys whose bucket another shard owns."""
+    owned = _owned(band_idx, keys, shard)
+    if owned is None:
+        return table.match(keys)
+    q, item = table.match(keys[owned])
+    return owned[q], item
+
+
+class _BucketTable:
+    """
+    Integer-keyed bucket table over item ids.
+    Items are stored sorted by key; each bucket is a contiguous run of `order`.
+    ids gives the item id of every key when the table holds a subset of the items.
+    """
+    
+    def __init__(self, keys, width, ids=None):
+        order = np.argsort(keys, kind='stable')
+        self.order = order if ids is None else ids[order]
+        self.width = width
+        if width <= CSR_MAX_WIDTH:
+            counts = np.bincount(keys.astype(np.intp), minlength=1 << width)
+            self.starts = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=self.starts[1:])
+            self.sorted_keys = None
+        else:
+            self.starts = None
+            self.sorted_keys = keys[order]
+    
+    def _ranges(self, query_keys):
+        if self.starts is not None:
+            query_keys = query_keys.astype(np.intp)
+            return self.starts[query_keys], self.starts[query_keys + 1]
+        return (np.searchsorted(self.sorted_keys, query_keys, side='left'),
+                np.searchsorted(self.sorted_keys, query_keys, side='right'))
+    
+    def match(self, query_keys):
+        """
+        Look up query keys.
+        Returns:
+            (query_idx, item_idx) arrays with one row per (query, item in its bucket)
+        """
+        left, right = self._ranges(query_keys)
+        counts = right - left
+        total = int(counts.sum())
+        query_idx = np.repeat(np.arange(len(query_keys)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        item_idx = self.order[np.repeat(left, counts) + offsets]
+        return query_idx, item_idx
+
+
+class MultiIndexHash:
+    """
+    Exact Hamming-radius search with multi-index hashing.
+    
+    How it works:
+    1. Split each hash into m disjoint substrings, one sorted table per substring
+    2. Pigeonhole: two hashes within distance r differ by at most r // m bits
+       in at least one substring
+    3. Probing every table within that radius finds every true neighbour;
+       candidates are then verified on the full hash, each pair once
+       (candidates_checked counts them)
+    
+    With a shard, only the buckets that shard owns (see bucket_shard) are indexed and
+    probed; the shards of a split run find every match between them.
+    """
+    
+    def __init__(self, max_distance, hash_bits=None, num_substrings=None):
+        """
+        Initialize the index. hash_bits is taken from the indexed hashes and
+        num_substrings picked from the data size if not given.
+        """
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.num_substrings = num_substrings
+        self.candidates_checked = 0
+    
+    def _choose_substrings(self, n):
+        """Pick the substring count with the lowest expected probe + candidate cost."""
+        best_m, best_cost = 1, float('inf')
+        # substrings are looked up as integers: at most 64 bits each
+        for m in range(-(-self.hash_bits // WORD_BITS), self.hash_bits // 2 + 1):
+            width = self.hash_bits // m
+            radius = self.max_distance // m
+            probes = sum(comb(width + 1, r) for r in range(radius + 1))
+            cost = m * probes * (1 + n / 2 ** width)
+            if cost < best_cost:
+                best_m, best_cost = m, cost
+        return best_m
+    
+    def build(self, hashes, shard=None):
+        """
+        Index an (N,) or (N, W) uint64 array of packed hashes.
+        shard: optional (shard id, number of shards) to index only that shard's buckets
+        """
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.hash_bits is None:
+            self.hash_bits = hash_bits_of(self.hashes)
+        if self.num_substrings is None:
+            self.num_substrings = self._choose_substrings(len(self.hashes))
+        
+        self.shard = shard
+        
+        m = self.num_substrings
+        bounds = [self.hash_bits * k // m for k in range(m + 1)]
+        self.substrings = []
+        self.substring_keys = []
+        for sub_idx, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            keys = _band_values(self.hashes, start, end - start, self.hash_bits)
+            self.substrings.append((start, end - start, _build_table(sub_idx, keys, end - start, shard)))
+            self.substring_keys.append(keys)
+        return self
+    
+    def _probe(self, query_hashes, max_distance, self_join=False):
+        radius = max_distance // self.num_substrings
+        query_keys = [_band_values(query_hashes, start, width, self.hash_bits)
+                      for start, width, _ in self.substrings]
+        found_q, found_i, found_d = [], [], []
+        
+        def verify(sub_idx, q, item):
+            # a pair is a candidate of the first substring it is within radius in: skip those an
+            # earlier substring already found, so every pair is verified (and counted) once
+            first = np.ones(len(q), dtype=bool)
+            for prev_idx in range(sub_idx):
+                first &= np.bitwise_count(query_keys[prev_idx][q] ^ self.substring_keys[prev_idx][item]) > radius
+            q, item = q[first], item[first]
+            self.candidates_checked += len(q)
+            dist = hamming_distance(query_hashes[q], self.hashes[item])
+            keep = dist <= max_distance
+            found_q.append(q[keep])
+            found_i.append(item[keep])
+            found_d.append(dist[keep])
+        
+        for sub_idx, (start, width, table) in enumerate(self.substrings):
+            keys = query_keys[sub_idx]
+            masks = _flip_masks(width, radius)
+            if self_join:
+                # one mask at a time keeps the self-join's candidate lists small
+                for mask in masks:
+                    q, item = _match(table, sub_idx, keys ^ mask, self.shard)
+                    keep = q < item
+                    verify(sub_idx, q[keep], item[keep])
+                continue
+            # external queries: every query against every mask in one lookup per block of queries
+            block = max(1, PROBE_BLOCK // len(masks))
+            for q0 in range(0, len(keys), block):
+                probe_keys = (keys[q0:q0 + block, None] ^ masks).ravel()
+                q, item = _match(table, sub_idx, probe_keys, self.shard)
+                verify(sub_idx, q // len(masks) + q0, item)
+        
+        if not found_q:
+            return _empty_edges()
+        q, item, dist = np.concatenate(found_q), np.concatenate(found_i), np.concatenate(found_d)
+        order = np.argsort(q * len(self.hashes) + item)
+        return q[order], item[order], dist[order]
+    
+    def query(self, query_hashes, max_distance=None):
+        """
+        Find every indexed hash within max_distance of each query hash.
+        Returns:
+            (query_idx, item_idx, distance) arrays, one row per match
+        """
+        query_hashes = np.asarray(query_hashes, dtype=np.uint64)
+        max_distance = self.max_distance if max_distance is None else max_distance
+        return self._probe(query_hashes, max_distance)
+    
+    def pairs(self):
+        """
+        Exact self-join of the indexed hashes.
+        Returns:
+            (i, j, distance) arrays for every pair i < j within max_distance
+        """
+        return self._probe(self.hashes, self.max_distance, self_join=True)
+
 
 class LSH:
     """
@@ -77,68 +521,271 @@ class LSH:
     
     How it works:
     1. Split each hash into multiple bands
-    2. Hash each band to a bucket ID
+    2. Use each band's integer value as its bucket key, one bucket table per band
     3. Images landing in the same bucket are candidates for comparison
+    
+    With multiprobe=True, buckets whose key differs by one bit are probed too,
+    which raises recall at the same band count.
+    
+    With a shard, only the buckets that shard owns (see bucket_shard) are indexed and
+    probed: every candidate pair comes from exactly one shard per band.
     """
     
-    def __init__(self, num_bands=8, rows_per_band=8):
+    def __init__(self, num_bands=8, rows_per_band=8, multiprobe=False, hash_bits=HASH_BITS, band_widths=None):
         """
         Initialize LSH index.
+        band_widths: explicit width of every band, for layouts where the bands do not
+        split the hash evenly (see tune_lsh); overrides num_bands and rows_per_band
         """
+        if band_widths is not None:
+            band_widths = [int(width) for width in band_widths]
+            if not band_widths or min(band_widths) < 1 or sum(band_widths) > hash_bits:
+                raise ValueError(f"Band widths {band_widths} do not fit in {hash_bits} bits")
+            if max(band_widths) > WORD_BITS:
+                raise ValueError(f"Bands are at most {WORD_BITS} bits wide, got {max(band_widths)}")
+            num_bands, rows_per_band = len(band_widths), max(band_widths)
+        elif num_bands * rows_per_band != hash_bits:
+            raise ValueError(
+                f"Hash size mismatch: expected {num_bands * rows_per_band} bits, "
+                f"got {hash_bits} bits"
+            )
+        elif rows_per_band > WORD_BITS:
+            raise ValueError(f"Bands are at most {WORD_BITS} bits wide, got {rows_per_band} rows per band")
+        else:
+            band_widths = [rows_per_band] * num_bands
+        
         self.num_bands = num_bands
         self.rows_per_band = rows_per_band
-        self.buckets = defaultdict(set)
-        
-        self.hash_size = num_bands * rows_per_band
-        # self._stored_hashes = {}
-    def _hash_band(self, image_hash, band_idx):
+        self.band_widths = band_widths
+        self.band_starts = [sum(band_widths[:band_idx]) for band_idx in range(num_bands)]
+        self.multiprobe = multiprobe
+        self.hash_bits = hash_bits
+        self.hash_size = sum(band_widths)
+        self.tables = []
+        self.shard = None
+    
+    def _band_keys(self, hashes, band_idx):
+        """Integer bucket keys of one band for an array of packed hashes."""
+        return _band_values(hashes, self.band_starts[band_idx], self.band_widths[band_idx], self.hash_bits)
+    
+    def _probe_masks(self, band_idx):
+        masks = [0]
+        if self.multiprobe:
+            masks += [1 << bit for bit in range(self.band_widths[band_idx])]
+        return np.array(masks, dtype=np.uint64)
+    
+    def index(self, hashes, shard=None):
         """
-        Extract and hash a specific band from the image hash.
-        Returns:
-            Bucket ID for this band (string)
+        Build the band tables over an (N,) or (N, W) uint64 array of packed hashes.
+        Images are identified by their integer position in the array.
+        shard: optional (shard id, number of shards) to index only that shard's buckets
         """
-        start = band_idx * self.rows_per_band
-        end = start + self.rows_per_band
-        band = image_hash[start:end]
-        
-        return f"{band_idx}_{band}"
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(self.hashes) and hash_bits_of(self.hashes) != self.hash_bits:
+            raise ValueError(f"Hash size mismatch: index expects {self.hash_bits} bits, "
+                             f"got {hash_bits_of(self.hashes)} bits")
+        self.shard = shard
+        self.tables = [_build_table(band_idx, self._band_keys(self.hashes, band_idx), self.band_widths[band_idx], shard)
+                       for band_idx in range(self.num_bands)]
+        return self
     
-    def index(self, image_name, image_hash):
-        """
-        Add an image to the LSH index.
+    def _collect(self, query_hashes, self_join):
+        n = len(self.hashes)
+        codes = []
+        for band_idx, table in enumerate(self.tables):
+            query_keys = self._band_keys(query_hashes, band_idx)
+            for mask in self._probe_masks(band_idx):
+                q, item = _match(table, band_idx, query_keys ^ mask, self.shard)
+                if self_join:
+                    keep = q < item
+                    q, item = q[keep], item[keep]
+                codes.append(q * n + item)
         
-        Args:
-            image_name: Filename or identifier
-            image_hash: Binary hash string (must be num_bands × rows_per_band bits)
-        """
-        if len(image_hash) != self.hash_size:
-                raise ValueError(
-                    f"Hash size mismatch: expected {self.hash_size} bits, "
-                    f"got {len(image_hash)} bits"
-                )
-        
-        for band_idx in range(self.num_bands):
-            bucket_id = self._hash_band(image_hash, band_idx)
-            self.buckets[bucket_id].add(image_name)
-            # self._stored_hashes[image_name] = image_hash
-    
-    def get_hash(self, image_name):
-        """get hash for verification"""
-        return self._stored_hashes.get(image_name)
+        # the same pair usually shares several buckets: keep it once
+        codes = _unique_codes(np.concatenate(codes)) if codes else np.empty(0, dtype=np.int64)
+        return codes // n, codes % n
     
+    def candidate_pairs(self):
+        """
+        Candidate pairs among the indexed images.
+        Returns:
+            (i, j) integer arrays with i < j, each pair listed once
+        """
+        return self._collect(self.hashes, self_join=True)
     
-    def get_candidates(self, image_name, image_hash):
+    def get_candidates(self, query_hashes):
         """
-        Only images in the same bucket are returned as candidates.
+        Candidates for external query hashes: only images in the same (or, with
+        multiprobe, a neighbouring) bucket are returned.
+        Returns:
+            (query_idx, item_idx) integer arrays
         """
-        candidates = set()
-        
-        # Collect candidates from all band buckets
-        for band_idx in range(self.num_bands):
-            bucket_id = self._hash_band(image_hash, band_idx)
-            candidates.update(self.buckets[bucket_id])
-        
-        # Remove the query image itself
-        candidates.discard(image_name)
-        return candidates
+        return self._collect(np.asarray(query_hashes, dtype=np.uint64), self_join=False)
+
+
+def even_band_widths(num_bands, hash_bits=HASH_BITS):
+    """Split hash_bits into num_bands widths differing by at most one bit (wider bands first)."""
+    width, extra = divmod(hash_bits, num_bands)
+    return [width + 1] * extra + [width] * (num_bands - extra)
+
+
+def lsh_recalls(max_distance, band_widths, multiprobe=False, hash_bits=HASH_BITS):
+    """
+    Probability that two hashes d bits apart land in a common bucket, for every d up to
+    max_distance, with the differing bits placed uniformly at random.
+    A pair is missed when every band holds at least one differing bit (two with
+    multiprobe); those placements are counted band by band with a small DP, which
+    yields the counts for every total number of differing bits at once.
+    Returns: Array of recalls indexed by distance
+    """
+    max_distance = min(max_distance, hash_bits)
+    min_bits = 2 if multiprobe else 1
+    # misses[k]: placements of k differing bits over the bands so far that miss every one of them
+    misses = [1] + [0] * max_distance
+    for band_idx, width in enumerate(list(band_widths) + [hash_bits - sum(band_widths)]):
+        low = min_bits if band_idx < len(band_widths) else 0
+        placed = [0] * (max_distance + 1)
+        for k, count in enumerate(misses):
+            if count:
+                for bits in range(low, min(width, max_distance - k) + 1):
+                    placed[k + bits] += count * comb(width, bits)
+        misses = placed
+    return np.array([1.0 - misses[d] / comb(hash_bits, d) for d in range(max_distance + 1)])
+
+
+def lsh_recall(distance, band_widths, multiprobe=False, hash_bits=HASH_BITS):
+    """Probability that two hashes `distance` bits apart land in a common bucket (see lsh_recalls)."""
+    if distance > hash_bits:
+        return 0.0
+    return float(lsh_recalls(distance, band_widths, multiprobe, hash_bits)[distance])
+
+
+def _band_collision_rate(sample, start, width, multiprobe, hash_bits):
+    """
+    Fraction of sample pairs whose keys in band [start, start + width) match (or are one bit
+    apart with multiprobe), from the band's key counts: no pairs are listed.
+    """
+    keys, counts = np.unique(_band_values(sample, start, width, hash_bits), return_counts=True)
+    counts = counts.astype(np.float64)
+    colliding = float((counts * (counts - 1) / 2).sum())
+    if multiprobe:
+        # every pair of keys one bit apart is seen from both ends
+        for bit in range(width):
+            neighbours = keys ^ np.uint64(1 << bit)
+            pos = np.minimum(np.searchsorted(keys, neighbours), len(keys) - 1)
+            found = keys[pos] == neighbours
+            colliding += float((counts[found] * counts[pos[found]]).sum()) / 2
+    return colliding / (len(sample) * (len(sample) - 1) / 2)
+
+
+def _band_match_probability(width, max_distance, multiprobe, hash_bits):
+    """
+    Probability that a band of the given width holds no differing bit (at most one with
+    multiprobe) of two hashes d bits apart, for every d up to max_distance, bits placed at random.
+    """
+    rest = hash_bits - width
+    return np.array([(comb(rest, d) + (width * comb(rest, d - 1) if multiprobe and d else 0)) / comb(hash_bits, d)
+                     for d in range(max_distance + 1)])
+
+
+def _estimate_layout(band_widths, max_distance, multiprobe, n, sample, near, hash_bits, cache=None):
+    """
+    estimate_lsh with the sample's near-pair distances already known.
+    cache: optional dict reused across layouts for the per-band sample statistics
+    """
+    recalls = lsh_recalls(max_distance, band_widths, multiprobe, hash_bits)
+    probes = [(width + 1 if multiprobe else 1) * 2.0 ** -width for width in band_widths]
+    collision_rate = 1.0 - np.prod([1.0 - min(p, 1.0) for p in probes])
+    expected_recall = recalls[-1]
+    
+    if sample is not None:
+        n = n if n is not None else len(sample)
+        cache = {} if cache is None else cache
+        total_pairs = len(sample) * (len(sample) - 1) / 2
+        near_counts = np.bincount(near, minlength=max_distance + 1)[:max_distance + 1].astype(np.float64)
+        if len(near):
+            expected_recall = float(near_counts @ recalls) / len(near)
+        # near pairs collide with their modelled recall; they also collide in many bands at once, so
+        # they are taken out of each band's key collisions before the other pairs' bands are
+        # combined as independent
+        far_pairs = total_pairs - len(near)
+        far_miss = 1.0
+        for start, width in zip(np.cumsum([0] + list(band_widths[:-1])).tolist(), band_widths):
+            key = (start, width, multiprobe)
+            if key not in cache:
+                cache[key] = _band_collision_rate(sample, start, width, multiprobe, hash_bits) * total_pairs
+            if (width, multiprobe) not in cache:
+                cache[width, multiprobe] = near_counts @ _band_match_probability(width, max_distance, multiprobe,
+                                                                                 hash_bits)
+            if far_pairs > 0:
+                far_miss *= 1.0 - min(max(cache[key] - cache[width, multiprobe], 0.0) / far_pairs, 1.0)
+        colliding = expected_recall * len(near) + far_pairs * (1.0 - far_miss)
+        # skewed real hashes collide more than random ones, never less in expectation
+        collision_rate = max(collision_rate, colliding / total_pairs)
     
+    n = n or 0
+    return float(expected_recall), float(collision_rate * n * (n - 1) / 2)
+
+
+def estimate_lsh(band_widths, max_distance, multiprobe=False, n=None, sample=None, hash_bits=HASH_BITS):
+    """
+    Expected recall and candidate count of an LSH layout, before running it.
+    
+    Args:
+        max_distance: Largest Hamming distance that counts as a duplicate
+        n: Number of hashes the layout will index (defaults to the sample size)
+        sample: Optional packed hashes drawn from the real data. Their near pairs weight
+            the recall by the actual distance distribution, and their per-band key counts
+            give the candidate rate; without one, recall is taken at max_distance
+            (the worst case) and hashes are assumed uniformly random
+    Returns:
+        (expected recall, expected candidate pairs)
+    """
+    sample, near = _sample_near(sample, max_distance)
+    return _estimate_layout(band_widths, max_distance, multiprobe, n, sample, near, hash_bits)
+
+
+def _sample_near(sample, max_distance):
+    """The sample as packed hashes and the distances of its pairs within max_distance."""
+    if sample is None or len(sample) < 2:
+        return None, None
+    sample = np.asarray(sample, dtype=np.uint64)
+    return sample, bruteforce_pairs(sample, max_distance)[2]
+
+
+def tune_lsh(max_distance, target_recall=0.95, n=None, sample=None, multiprobe=False, hash_bits=HASH_BITS):
+    """
+    Pick the LSH layout with the fewest expected candidates that still reaches target_recall.
+    Layouts split the hash into nearly even bands of at most 64 bits, so band counts that do
+    not divide hash_bits are covered too; with multiprobe=True both probing modes are tried.
+    If no layout reaches the target, the one with the highest recall is returned.
+    Returns:
+        dict with band_widths, multiprobe, expected_recall and expected_candidates
+    """
+    # the sample's near pairs do not depend on the layout: find them once
+    sample, near = _sample_near(sample, max_distance)
+    cache = {}
+    best = None
+    for num_bands in range(-(-hash_bits // WORD_BITS), hash_bits + 1):
+        band_widths = even_band_widths(num_bands, hash_bits)
+        fewest = None
+        for probe in ([False, True] if multiprobe else [False]):
+            recall, candidates = _estimate_layout(band_widths, max_distance, probe, n, sample, near, hash_bits,
+                                                  cache)
+            fewest = candidates if fewest is None else min(fewest, candidates)
+            reached = recall >= target_recall
+            key = (not reached, candidates if reached else -recall, num_bands)
+            if best is None or key < best[0]:
+                best = (key, {
+                    'band_widths': band_widths,
+                    'multiprobe': probe,
+                    'expected_recall': round(recall, 4),
+                    'expected_candidates': int(round(candidates)),
+                })
+        if num_bands > max_distance:
+            # pigeonhole: every pair within max_distance already shares a band, more bands only add candidates
+            break
+        if not best[0][0] and fewest >= best[0][1]:
+            # the target is reached and narrower bands only bring more candidates from here on
+            break
+    return best[1]